@@ -0,0 +1,357 @@
+# Public Domain (-) 2004-2012 The Redpill Authors.
+# See the Redpill UNLICENSE file for details.
+
+"""Benchmarks for redpill's own planning, scanning and install overhead."""
+
+import os
+import sys
+import tarfile
+
+from BaseHTTPServer import HTTPServer
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from hashlib import sha256
+from optparse import OptionParser
+from os import environ, makedirs, remove
+from os.path import isdir, isfile, join
+from random import Random
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from thread import start_new_thread
+from time import time
+
+from simplejson import dumps as encode_json, loads as decode_json
+
+# ------------------------------------------------------------------------------
+# Synthetic Environ
+# ------------------------------------------------------------------------------
+
+# Generate a dependency graph of ``count`` packages made up of a deep chain
+# ``depth`` packages long with the rest requiring a handful of random earlier
+# packages, which creates plenty of diamonds.
+def generate_graph(count, depth, fanout, seed):
+    random = Random(seed)
+    graph = []
+    for idx in range(count):
+        requires = set()
+        if 0 < idx < depth:
+            requires.add(idx - 1)
+        elif idx >= depth:
+            for _ in range(random.randint(1, fanout)):
+                requires.add(random.randrange(idx))
+        graph.append(sorted(requires))
+    return graph
+
+def package_name(idx):
+    return 'pkg%04d' % idx
+
+def create_distfile(directory, name, version, size):
+    path = join(directory, '%s-%s.tar.bz2' % (name, version))
+    tar = tarfile.open(path, 'w:bz2')
+    data = os.urandom(size)
+    member = tarfile.TarInfo('%s/payload' % name)
+    member.size = len(data)
+    tar.addfile(member, StringIO(data))
+    tar.close()
+    distfile = open(path, 'rb')
+    digest = sha256(distfile.read()).hexdigest()
+    distfile.close()
+    return digest
+
+def create_environ(base, options, url):
+    environ_path = join(base, 'environ')
+    distfiles = join(base, 'distfiles')
+    for directory in [environ_path, join(environ_path, 'roles'), distfiles]:
+        makedirs(directory)
+    graph = generate_graph(
+        options.recipes, options.depth, options.fanout, options.seed
+        )
+    hashes = {}
+    for idx in range(options.distfiles):
+        hashes[idx] = create_distfile(
+            distfiles, package_name(idx), '1.0', options.distfile_size
+            )
+    recipes = open(join(environ_path, 'buildrecipes'), 'wb')
+    for idx, requires in enumerate(graph):
+        recipe = {
+            'version': '1.0',
+            'hash': hashes.get(idx, '0' * 64),
+            'requires': [package_name(dep) for dep in requires]
+            }
+        recipes.write("RECIPES[%r] = [%r]\n" % (package_name(idx), recipe))
+    recipes.close()
+    # The role asks for the packages which nothing else depends on.
+    required = set(dep for requires in graph for dep in requires)
+    role = open(join(environ_path, 'roles', 'default.yaml'), 'wb')
+    role.write('packages:\n')
+    for idx in range(len(graph)):
+        if idx not in required:
+            role.write('  - %s\n' % package_name(idx))
+    role.close()
+    conf = open(join(environ_path, 'redpill.yaml'), 'wb')
+    conf.write('distfiles-url-base: %s\nrole: default\n' % url)
+    conf.close()
+    return environ_path, distfiles, graph, hashes
+
+# Populate ``local`` with a tree of ``count`` files spread over a few levels of
+# directories and write receipts for them spread over ``receipts`` packages.
+def create_local_tree(local, receipts, count, receipt_count):
+    listings = [[] for _ in range(receipt_count)]
+    for idx in range(count):
+        directory = 'd%02d/e%02d' % (idx % 50, (idx // 50) % 20)
+        path = join(local, directory)
+        if not isdir(path):
+            makedirs(path)
+        filename = '%s/f%06d' % (directory, idx)
+        open(join(local, filename), 'wb').close()
+        listings[idx % receipt_count].append(filename)
+    if not isdir(receipts):
+        makedirs(receipts)
+    for idx, listing in enumerate(listings):
+        receipt = open(join(receipts, 'synthetic%04d-1.0' % idx), 'wb')
+        receipt.write('\n'.join(sorted(listing)))
+        receipt.close()
+
+# Serve the given ``directory`` over HTTP from a background thread.
+def start_server(directory):
+    class Handler(SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return join(directory, path.split('?', 1)[0].lstrip('/'))
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    start_new_thread(server.serve_forever, ())
+    return server
+
+# ------------------------------------------------------------------------------
+# Benchmark Runner
+# ------------------------------------------------------------------------------
+
+class Quiet(object):
+    """Swallow anything printed by redpill whilst a benchmark runs."""
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def run_benchmark(name, func, repeat, setup=None):
+    runs = []
+    for _ in range(repeat):
+        with Quiet():
+            if setup:
+                setup()
+            start = time()
+            func()
+            runs.append(time() - start)
+    ordered = sorted(runs)
+    result = {
+        'max': ordered[-1],
+        'mean': sum(runs) / len(runs),
+        'median': ordered[len(ordered) // 2],
+        'min': ordered[0],
+        'runs': runs
+        }
+    print "%-28s min %9.4fs  median %9.4fs  max %9.4fs" % (
+        name, result['min'], result['median'], result['max']
+        )
+    return result
+
+def run_benchmarks(options, base):
+    server = start_server(join(base, 'distfiles'))
+    url = 'http://127.0.0.1:%d/' % server.server_port
+    environ_path, _, graph, hashes = create_environ(base, options, url)
+
+    environ['REDPILL_ENVIRON'] = environ_path
+    environ['REDPILL_NOCOLOR'] = '1'
+    environ['REDPILL_STATE'] = join(base, 'state')
+
+    # The redpill module is bound to its environ on import, so it can only be
+    # imported once the synthetic environ is in place.
+    from redpill import main as rp
+
+    def reset_recipes():
+        rp.unlock(rp.BUILD_LOCK)
+        rp.RECIPES.clear()
+        rp.PACKAGES.clear()
+        del rp.RECIPES_INITIALISED[:]
+        reset_roles()
+
+    def reset_roles():
+        rp.ROLES.clear()
+        rp.TO_INSTALL.clear()
+
+    def load_role():
+        rp.load_role('default')
+
+    def prepare_local():
+        for path in [rp.LOCAL, rp.RECEIPTS]:
+            if isdir(path):
+                rmtree(path)
+        create_local_tree(
+            rp.LOCAL, rp.RECEIPTS, options.files, options.receipts
+            )
+        installed = rp.get_installed_packages()
+        installed.clear()
+        installed.update(
+            dict(f.split('-', 1) for f in os.listdir(rp.RECEIPTS))
+            )
+
+    def prepare_uninstall():
+        prepare_local()
+        rp.TO_UNINSTALL.clear()
+        for package in rp.get_installed_packages().keys():
+            rp.uninstall_package(package)
+
+    def prepare_downloads():
+        for idx in hashes:
+            path = join(rp.DISTFILES, '%s-1.0.tar.bz2' % package_name(idx))
+            if isfile(path):
+                remove(path)
+
+    def download(fork):
+        def run():
+            for idx in sorted(hashes):
+                name = package_name(idx)
+                rp.download_distfile(
+                    '%s-1.0.tar.bz2' % name, url + '%s-1.0.tar.bz2' % name,
+                    hashes[idx], fork=fork, package=name
+                    )
+            rp.DOWNLOAD_POOL.wait()
+            if rp.DOWNLOAD_ERROR:
+                raise RuntimeError(rp.DOWNLOAD_ERROR[0].msg)
+        return run
+
+    results = {}
+    repeat = options.repeat
+    results['init_build_recipes'] = run_benchmark(
+        'init_build_recipes', rp.init_build_recipes, repeat, reset_recipes
+        )
+    results['load_role'] = run_benchmark(
+        'load_role', load_role, repeat, reset_roles
+        )
+    all_packages = list(rp.RECIPES)
+    results['sort_by_dependencies'] = run_benchmark(
+        'sort_by_dependencies',
+        lambda: rp.sort_by_dependencies(all_packages), repeat
+        )
+    load_role()
+    results['plan_install'] = run_benchmark(
+        'plan_install', rp.plan_install, repeat
+        )
+    prepare_local()
+    results['gather_local_filelisting'] = run_benchmark(
+        'gather_local_filelisting',
+        lambda: rp.gather_local_filelisting(rp.LOCAL), repeat
+        )
+    results['get_listing'] = run_benchmark(
+        'get_listing', rp.get_listing, repeat
+        )
+    results['cleanup_install'] = run_benchmark(
+        'cleanup_install', rp.cleanup_install, repeat
+        )
+    results['uninstall_packages'] = run_benchmark(
+        'uninstall_packages', rp.uninstall_packages, repeat, prepare_uninstall
+        )
+    if not isdir(rp.DISTFILES):
+        makedirs(rp.DISTFILES)
+    results['download_serial'] = run_benchmark(
+        'download_serial', download(False), repeat, prepare_downloads
+        )
+    results['download_threaded'] = run_benchmark(
+        'download_threaded', download(True), repeat, prepare_downloads
+        )
+    results['download_verify_cached'] = run_benchmark(
+        'download_verify_cached', download(False), repeat
+        )
+    rmtree(rp.BUILD_WORKING_DIRECTORY)
+    server.shutdown()
+    return results
+
+def get_revision():
+    try:
+        from redpill.main import run_command
+        return run_command(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__)
+            ).strip()
+    except Exception:
+        return None
+
+def compare(results, baseline_path):
+    baseline_file = open(baseline_path, 'rb')
+    baseline = decode_json(baseline_file.read())['results']
+    baseline_file.close()
+    print
+    print "%-28s %12s %12s %8s" % ('benchmark', 'baseline', 'current', 'ratio')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['median']
+        new = results[name]['median']
+        print "%-28s %11.4fs %11.4fs %7.2fx" % (
+            name, old, new, old and new / old or 0
+            )
+
+# ------------------------------------------------------------------------------
+# Main Runner
+# ------------------------------------------------------------------------------
+
+def main(argv=None):
+    """benchmark redpill's planning, scanning and install hot paths"""
+
+    usage = "Usage: redpill benchmark [options]\n\n    %s" % main.__doc__
+    op = OptionParser(usage=usage)
+
+    op.add_option('--recipes', type='int', default=500,
+                  help="number of synthetic recipes [500]")
+    op.add_option('--depth', type='int', default=50,
+                  help="length of the deepest dependency chain [50]")
+    op.add_option('--fanout', type='int', default=4,
+                  help="maximum number of requires per recipe [4]")
+    op.add_option('--files', type='int', default=50000,
+                  help="number of files in the synthetic local tree [50000]")
+    op.add_option('--receipts', type='int', default=200,
+                  help="number of receipts covering the local tree [200]")
+    op.add_option('--distfiles', type='int', default=20,
+                  help="number of distfiles to download [20]")
+    op.add_option('--distfile-size', dest='distfile_size', type='int',
+                  default=256 * 1024, help="size of each distfile [262144]")
+    op.add_option('--repeat', type='int', default=5,
+                  help="number of times to run each benchmark [5]")
+    op.add_option('--seed', type='int', default=0,
+                  help="seed for the synthetic dependency graph [0]")
+    op.add_option('--output', help="save the results as JSON to this path")
+    op.add_option('--compare', help="compare against a saved JSON result")
+    op.add_option('--keep', action='store_true',
+                  help="keep the generated environ for inspection")
+
+    options, args = op.parse_args(argv)
+
+    base = mkdtemp(prefix='redpill-benchmark-')
+    try:
+        results = run_benchmarks(options, base)
+    finally:
+        if options.keep:
+            print "Kept the generated environ at %s" % base
+        else:
+            rmtree(base)
+
+    if options.output:
+        output = open(options.output, 'wb')
+        output.write(encode_json({
+            'options': options.__dict__,
+            'python': sys.version,
+            'results': results,
+            'revision': get_revision(),
+            'time': time()
+            }, indent=2, sort_keys=True))
+        output.close()
+
+    if options.compare:
+        compare(results, options.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Public Domain (-) 2004-2012 The Redpill Authors.
+# See the Redpill UNLICENSE file for details.
+
+"""Run a setup.py with distutils compiling extensions in parallel."""
+
+import sys
+
+from distutils import ccompiler
+from distutils.command import build_ext
+from multiprocessing.pool import ThreadPool
+from os.path import abspath, dirname
+from threading import BoundedSemaphore
+
+# ------------------------------------------------------------------------------
+# Parallel Compilation
+# ------------------------------------------------------------------------------
+
+# The distutils in Python 2 builds extensions, and the sources within each of
+# them, one at a time. As the actual work is done by compiler subprocesses, we
+# run them from a pool of threads instead, with the number of concurrent
+# compiles limited to the number of jobs.
+JOBS = 1
+COMPILE_SLOTS = None
+
+def run_parallel(func, items):
+    if len(items) < 2:
+        return map(func, items)
+    pool = ThreadPool(min(JOBS, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def compile(self, sources, output_dir=None, macros=None, include_dirs=None,
+            debug=0, extra_preargs=None, extra_postargs=None, depends=None):
+    macros, objects, extra_postargs, pp_opts, build = self._setup_compile(
+        output_dir, macros, include_dirs, sources, depends, extra_postargs
+        )
+    cc_args = self._get_cc_args(pp_opts, debug, extra_preargs)
+    def compile_object(obj):
+        src, ext = build[obj]
+        with COMPILE_SLOTS:
+            self._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+    run_parallel(compile_object, [obj for obj in objects if obj in build])
+    # Return all of the object filenames, just like distutils does.
+    return objects
+
+def build_extensions(self):
+    self.check_extensions_list(self.extensions)
+    run_parallel(self.build_extension, self.extensions)
+
+def enable_parallel_builds(jobs):
+    global COMPILE_SLOTS, JOBS
+    JOBS = jobs
+    COMPILE_SLOTS = BoundedSemaphore(jobs)
+    ccompiler.CCompiler.compile = compile
+    build_ext.build_ext.build_extensions = build_extensions
+
+# ------------------------------------------------------------------------------
+# Main Runner
+# ------------------------------------------------------------------------------
+
+# Usage: python -m redpill.buildext --jobs=<n> setup.py [commands]
+def main(argv=None):
+    argv = argv or sys.argv[1:]
+    if not (argv and argv[0].startswith('--jobs=')) or len(argv) < 2:
+        sys.exit("Usage: python -m redpill.buildext --jobs=<n> setup.py ...")
+    jobs = int(argv[0].split('=', 1)[1])
+    if jobs > 1:
+        enable_parallel_builds(jobs)
+    sys.argv = argv[1:]
+    path = sys.argv[0]
+    sys.path.insert(0, dirname(abspath(path)))
+    execfile(path, {'__file__': path, '__name__': '__main__'})
+
+if __name__ == '__main__':
+    main()
@@ -12,33 +12,127 @@
 
 import os
 import sys
-import subprocess
-import tarfile
 import traceback
 
-from errno import EACCES, ENOENT
+from collections import deque
+from contextlib import contextmanager
+from errno import EACCES, EAGAIN, ENOENT, EPERM
+from fnmatch import fnmatch
 from glob import glob
 from hashlib import sha1, sha256
 from optparse import OptionParser
 from os import chdir, getcwd, environ, listdir, makedirs, remove, stat
-from os.path import dirname, exists, isabs, isdir, isfile, islink, join
+from os.path import basename, dirname, exists, isabs, isdir, isfile, islink
+from os.path import join
 from shutil import copy, copytree, rmtree
+from signal import SIGTERM, signal
+from socket import AF_UNIX, SOCK_STREAM, error as socket_error, socket
+from SocketServer import StreamRequestHandler, ThreadingMixIn
+from SocketServer import UnixStreamServer
 from stat import ST_MTIME
-from thread import start_new_thread
-from time import sleep
+from thread import get_ident
+from threading import Event, Lock, Thread, Timer, local
+from time import localtime, sleep, strftime, time
 
 from redpill.version import __release__
-from requests import get as urlopen
-from simplejson import loads as decode_json
 from tavutil.optcomplete import autocomplete, ListCompleter
 from tavutil.optcomplete import make_autocompleter, parse_options
-from yaml import safe_load as decode_yaml
 
 try:
     from multiprocessing import cpu_count
 except ImportError:
     cpu_count = lambda: 1
 
+# ------------------------------------------------------------------------------
+# Lazy Imports
+# ------------------------------------------------------------------------------
+
+# Importing requests and yaml takes longer than the rest of startup put
+# together, so they and the other heavier modules are only imported on first
+# use. This keeps simple commands and tab completion fast.
+def decode_json(data, **kwargs):
+    from simplejson import loads
+    return loads(data, **kwargs)
+
+def encode_json(data, **kwargs):
+    from simplejson import dumps
+    return dumps(data, **kwargs)
+
+def decode_yaml(data):
+    from yaml import safe_load
+    return safe_load(data)
+
+def urlopen(url, **kwargs):
+    from requests import get
+    return get(url, **kwargs)
+
+# ------------------------------------------------------------------------------
+# Event Stream
+# ------------------------------------------------------------------------------
+
+# Progress can be emitted as timestamped JSON lines, so that builds can be
+# monitored without scraping the coloured output. The ``--events=json`` global
+# option writes the events to stdout in place of the usual output, whilst the
+# ``$REDPILL_EVENTS`` environment variable can be set to a file descriptor or a
+# path to write them to alongside it.
+EVENTS = []
+EVENTS_LOCK = Lock()
+EVENTS_ONLY = False
+
+def open_events(target):
+    global EVENTS_ONLY
+    if target == 'json':
+        EVENTS_ONLY = True
+        stream = sys.stdout
+    elif target.isdigit():
+        stream = os.fdopen(int(target), 'ab')
+    else:
+        stream = open(target, 'ab')
+    EVENTS[:] = [stream]
+
+def close_events():
+    global EVENTS_ONLY
+    for stream in EVENTS:
+        if stream is not sys.stdout:
+            stream.close()
+    del EVENTS[:]
+    EVENTS_ONLY = False
+
+def emit(event, **data):
+    if not EVENTS:
+        return
+    data['event'] = event
+    data['time'] = time()
+    line = encode_json(data, sort_keys=True) + '\n'
+    with EVENTS_LOCK:
+        EVENTS[0].write(line)
+        EVENTS[0].flush()
+
+class EventOutput(object):
+    """File-like object which emits each line written to it as an event."""
+
+    def write(self, data):
+        for line in data.splitlines():
+            emit('output', line=line)
+
+    def flush(self):
+        pass
+
+# Emit events for the start and exit of a build ``command``.
+@contextmanager
+def command_events(package, command):
+    emit('command_start', command=command, package=package)
+    start = time()
+    status = 'failed'
+    try:
+        yield
+        status = 'success'
+    finally:
+        emit(
+            'command_exit', command=command, duration=time() - start,
+            package=package, status=status
+            )
+
 # ------------------------------------------------------------------------------
 # Print Functions
 # ------------------------------------------------------------------------------
@@ -59,18 +153,37 @@ else:
     SUCCESS = '** '
     TERMTITLE = ''
 
+LOG_LEVELS = {
+    ACTION: 'action', ERROR: 'error', PROGRESS: 'progress', SUCCESS: 'success'
+    }
+
 # Pretty print the given ``message`` in nice colours.
 def log(message, type=ACTION):
-    print type + message + NORMAL
+    emit('log', level=LOG_LEVELS.get(type, 'action'), message=message)
+    if not EVENTS_ONLY:
+        print type + message + NORMAL
 
 def error(message):
-    print ERROR + message + NORMAL
-    print ''
+    emit('log', level='error', message=message)
+    if not EVENTS_ONLY:
+        print ERROR + message + NORMAL
+        print ''
 
 def exit(message):
-    print ERROR + message + NORMAL
+    emit('log', level='error', message=message)
+    if not EVENTS_ONLY:
+        print ERROR + message + NORMAL
     sys.exit(1)
 
+def log_removal(path, directory=False):
+    emit('remove', path=path)
+    if EVENTS_ONLY:
+        return
+    if directory:
+        print "Removing Directory:", path
+    else:
+        print "Removing:", path
+
 # ------------------------------------------------------------------------------
 # Platform Detection
 # ------------------------------------------------------------------------------
@@ -101,28 +214,74 @@ ENVIRON = environ.get("REDPILL_ENVIRON")
 if not ENVIRON:
     exit("ERROR: The $REDPILL_ENVIRON directory variable hasn't been specified.")
 
-conf_path = join(ENVIRON, 'redpill.yaml')
-try:
-    conf_file = open(conf_path, 'rb')
-except Exception, err:
-    exit("ERROR: Couldn't open the redpill.yaml file: %s" % err)
+CONF_PATH = join(ENVIRON, 'redpill.yaml')
+CONF = {}
 
-conf = decode_yaml(conf_file.read())
-conf_file.close()
+# Depending on whether its speedups are available, simplejson decodes strings as
+# either str or unicode, whereas yaml gives str for any ASCII text. So values
+# from the cached config are normalised to match what yaml would give.
+def normalise_conf(value):
+    if isinstance(value, unicode):
+        try:
+            return value.encode('ascii')
+        except UnicodeError:
+            return value
+    if isinstance(value, list):
+        return [normalise_conf(item) for item in value]
+    if isinstance(value, dict):
+        return dict(
+            (normalise_conf(k), normalise_conf(v)) for k, v in value.iteritems()
+            )
+    return value
 
-if not conf:
-    exit("ERROR: Empty config found in %s" % conf_path)
+# The config is loaded on first use. As parsing it needs yaml, the parsed
+# config is cached as JSON in the state directory and reused for as long as
+# the redpill.yaml file remains unchanged. Configs which JSON can't represent
+# exactly, e.g. with non-string keys, are never cached.
+def load_conf():
+    try:
+        info = stat(CONF_PATH)
+    except OSError, err:
+        exit("ERROR: Couldn't open the redpill.yaml file: %s" % err)
+    key = [info.st_mtime, info.st_size]
+    cache_path = join(STATE, 'conf.json')
+    if isfile(cache_path):
+        try:
+            cache = decode_json(read_file(cache_path))
+            if cache['key'] == key:
+                return normalise_conf(cache['conf'])
+        except Exception:
+            pass
+    try:
+        conf_file = open(CONF_PATH, 'rb')
+    except Exception, err:
+        exit("ERROR: Couldn't open the redpill.yaml file: %s" % err)
+    conf = decode_yaml(conf_file.read())
+    conf_file.close()
+    if not conf:
+        exit("ERROR: Empty config found in %s" % CONF_PATH)
+    try:
+        data = encode_json({'conf': conf, 'key': key})
+        if repr(normalise_conf(decode_json(data)['conf'])) == repr(conf):
+            mkdir(STATE)
+            tmp_path = '%s.%d' % (cache_path, os.getpid())
+            cache_file = open(tmp_path, 'wb')
+            cache_file.write(data)
+            cache_file.close()
+            os.rename(tmp_path, cache_path)
+    except Exception:
+        pass
+    return conf
 
 sentinel = object()
-def get_conf(key, default=sentinel, conf=conf, path=conf_path):
-    value = conf.get(key, default)
+def get_conf(key, default=sentinel):
+    if not CONF:
+        CONF.update(load_conf())
+    value = CONF.get(key, default)
     if value is sentinel:
-        exit("ERROR: Config value for %s not found in %s" % (key, path))
+        exit("ERROR: Config value for %s not found in %s" % (key, CONF_PATH))
     return value
 
-del conf_file
-del conf_path
-
 # -----------------------------------------------------------------------------
 # Command Execution
 # -----------------------------------------------------------------------------
@@ -135,12 +294,42 @@ def exit_cmd(message, error_code=1):
 class CommandNotFound(Exception):
     """Exception raised when a command line app could not be found."""
 
+# The total wall time spent waiting on subprocesses and the number of them.
+SUBPROCESS_STATS = [0.0, 0]
+
+# The number of trailing lines of captured output kept in memory.
+CAPTURE_TAIL_LINES = 50
+
+# Set whilst the daemon is serving a command, so that the output of any
+# subprocesses is relayed to the client instead of the daemon's terminal.
+SERVING = False
+
+# Stream the combined output of the given ``process`` line by line to the
+# ``capture`` file, keeping only a bounded tail in memory, which is returned.
+def stream_output(process, capture, progress=None, tail=CAPTURE_TAIL_LINES):
+    lines = deque(maxlen=tail)
+    for line in iter(process.stdout.readline, ''):
+        capture.write(line)
+        lines.append(line)
+        if progress:
+            progress(line)
+    capture.flush()
+    return ''.join(lines)
+
 def run_command(
     args, retcode=False, reterror=False, exit_on_error=False, error_message="",
     log=None, redirect_stdout=True, redirect_stderr=True, cwd=None,
-    shell=sys.platform.startswith('win'), env=None, universal_newlines=True
+    shell=sys.platform.startswith('win'), env=None, universal_newlines=True,
+    capture=None, progress=None, timeout=None
     ):
-    """Execute the command with the given options."""
+    """Execute the command with the given options.
+
+    If a ``capture`` file is given, stdout and stderr are streamed to it and
+    only the tail of the output is returned. If a ``timeout`` is given, the
+    command is killed once it has run for that many seconds.
+    """
+
+    import subprocess
 
     log_message = "%s cwd=%s" % (' '.join(args), cwd or getcwd())
     if log:
@@ -159,12 +348,34 @@ def run_command(
     else:
         stderr = None
 
+    if capture is None and stdout is None and stderr is None:
+        if EVENTS_ONLY:
+            capture = EventOutput()
+        elif SERVING:
+            capture = sys.stdout
+
+    if capture:
+        stdout = subprocess.PIPE
+        stderr = subprocess.STDOUT
+
+    start = time()
+    timer = None
     try:
         process = subprocess.Popen(
             args, stdout=stdout, stderr=stderr, shell=shell, cwd=cwd, env=env,
             universal_newlines=universal_newlines
             )
-        out, err = process.communicate()
+        task = getattr(TASK_STATE, 'task', None)
+        if task:
+            task.processes.append(process)
+        if timeout:
+            timer = Timer(timeout, kill_process, (process,))
+            timer.start()
+        if capture:
+            out, err = stream_output(process, capture, progress), None
+            process.wait()
+        else:
+            out, err = process.communicate()
     except OSError:
         error = sys.exc_info()[1]
         if error.errno == 2:
@@ -176,9 +387,17 @@ def run_command(
         if exit_on_error:
             exit_cmd("Error running: %s\n\n%s" % (log_message, error_message))
         raise
+    finally:
+        if timer:
+            timer.cancel()
+        SUBPROCESS_STATS[0] += time() - start
+        SUBPROCESS_STATS[1] += 1
+
+    if timer and getattr(process, 'killed', False):
+        error_message = "Timed out after %s seconds." % timeout
 
     if process.returncode and exit_on_error:
-        if stderr:
+        if stderr and not capture:
             exit_extra = error_message or err
         else:
             exit_extra = error_message or out
@@ -196,6 +415,164 @@ def run_command(
         return out, err
     return out
 
+def kill_process(process):
+    if process.poll() is None:
+        process.killed = True
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+# ------------------------------------------------------------------------------
+# Task Execution
+# ------------------------------------------------------------------------------
+
+JOBS = int(environ.get('REDPILL_JOBS', NUMBER_OF_CPUS))
+
+# The task currently being run by a thread, so that any subprocesses it starts
+# can be killed if the task is cancelled or times out.
+TASK_STATE = local()
+
+class TaskCancelled(Exception):
+    """Exception raised for queued tasks when their pool is cancelled."""
+
+class TaskTimeout(Exception):
+    """Exception raised when a task runs for longer than its timeout."""
+
+class Task(object):
+    """A function call that is run by a ``TaskPool``."""
+
+    def __init__(self, func, args, kwargs, name, timeout):
+        self.args = args
+        self.done = Event()
+        self.error = None
+        self.func = func
+        self.kwargs = kwargs
+        self.name = name
+        self.processes = []
+        self.result = None
+        self.started = None
+        self.timeout = timeout
+
+    def run(self):
+        TASK_STATE.task = self
+        self.started = time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except BaseException:
+            if not self.error:
+                self.error = sys.exc_info()
+        TASK_STATE.task = None
+        self.done.set()
+
+    def fail(self, error):
+        if not self.done.isSet():
+            self.error = (error.__class__, error, None)
+            self.kill()
+            self.done.set()
+
+    def kill(self):
+        for process in self.processes:
+            kill_process(process)
+
+    def expired(self):
+        return (
+            self.timeout and self.started and not self.done.isSet() and
+            time() - self.started > self.timeout
+            )
+
+    def wait(self, poll=0.1):
+        """Wait for the task to finish and return its result, re-raising any
+        exception that it raised."""
+        while not self.done.wait(poll) and not self.done.isSet():
+            if self.expired():
+                self.fail(TaskTimeout(
+                    "%s timed out after %s seconds" % (self.name, self.timeout)
+                    ))
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+class TaskPool(object):
+    """Run function calls concurrently on a bounded number of threads.
+
+    Blocking calls, like ``run_command`` and ``urlopen``, can be used freely
+    within the tasks. If any task fails or times out when waiting on the pool,
+    the tasks still in the queue are cancelled and the subprocesses of the
+    running ones are killed.
+    """
+
+    def __init__(self, limit=None, timeout=None):
+        self.cancelled = False
+        self.limit = limit or JOBS
+        self.lock = Lock()
+        self.queue = deque()
+        self.running = 0
+        self.tasks = []
+        self.timeout = timeout
+
+    def spawn(self, func, *args, **kwargs):
+        name = kwargs.pop('task_name', getattr(func, '__name__', 'task'))
+        timeout = kwargs.pop('task_timeout', self.timeout)
+        task = Task(func, args, kwargs, name, timeout)
+        self.lock.acquire()
+        try:
+            self.tasks.append(task)
+            if self.cancelled:
+                task.fail(TaskCancelled(name))
+            else:
+                self.queue.append(task)
+        finally:
+            self.lock.release()
+        self.schedule()
+        return task
+
+    def schedule(self):
+        self.lock.acquire()
+        try:
+            while self.queue and self.running < self.limit:
+                task = self.queue.popleft()
+                self.running += 1
+                thread = Thread(target=self.run, args=(task,))
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self.lock.release()
+
+    def run(self, task):
+        try:
+            task.run()
+        finally:
+            self.lock.acquire()
+            self.running -= 1
+            self.lock.release()
+            self.schedule()
+
+    def cancel(self):
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            queued = list(self.queue)
+            self.queue.clear()
+        finally:
+            self.lock.release()
+        for task in queued:
+            task.fail(TaskCancelled(task.name))
+        for task in self.tasks:
+            task.kill()
+
+    def wait(self):
+        """Wait for all of the spawned tasks and return their results."""
+        try:
+            results = [task.wait() for task in list(self.tasks)]
+        except BaseException:
+            self.cancel()
+            raise
+        self.lock.acquire()
+        self.tasks = [task for task in self.tasks if not task.done.isSet()]
+        self.lock.release()
+        return results
+
 # ------------------------------------------------------------------------------
 # Utility Functions
 # ------------------------------------------------------------------------------
@@ -209,6 +586,31 @@ def do(*cmd, **kwargs):
         kwargs['exit_on_error'] = True
     return run_command(cmd, **kwargs)
 
+# Return a function which displays the latest line of output on a single,
+# continually updated, terminal line. It's throttled so that chatty builds don't
+# slow down over slow connections. Nothing is displayed when stdout is reserved
+# for events.
+def get_progress_display(prefix, interval=0.1):
+    if EVENTS_ONLY or not sys.stdout.isatty():
+        return None
+    width = int(environ.get('COLUMNS', 80)) - 1
+    last = [0]
+    def progress(line):
+        now = time()
+        if now - last[0] < interval:
+            return
+        last[0] = now
+        line = (prefix + line.strip().expandtabs())[:width]
+        sys.stdout.write('\r' + line.ljust(width))
+        sys.stdout.flush()
+    return progress
+
+def clear_progress_display():
+    if sys.stdout.isatty() and not EVENTS_ONLY:
+        width = int(environ.get('COLUMNS', 80)) - 1
+        sys.stdout.write('\r' + ' ' * width + '\r')
+        sys.stdout.flush()
+
 def query(question, options='Y/n', default='Y', alter=1):
     if alter:
         if options:
@@ -255,54 +657,204 @@ def rmdir(path, name=None):
 
 LOCKS = {}
 
-def lock(path):
-    LOCKS[path] = lock = open(path, 'w')
+# By default, we exit straight away if a lock is held by another process. This
+# can be changed with the global ``--wait`` option or the ``$REDPILL_WAIT``
+# environment variable to wait forever (True) or for a number of seconds.
+LOCK_WAIT = False
+
+def parse_lock_wait(value):
+    if value in ('', 'forever'):
+        return True
+    try:
+        return float(value)
+    except ValueError:
+        exit("ERROR: Invalid lock wait timeout: %r" % value)
+
+if 'REDPILL_WAIT' in environ:
+    LOCK_WAIT = parse_lock_wait(environ['REDPILL_WAIT'])
+
+# Acquire a shared or exclusive lock on the given ``path``. Locks are reentrant
+# within a process, so calling this again for a held lock changes its mode.
+def lock(path, shared=False, wait=None):
     try:
-        from fcntl import flock, LOCK_EX, LOCK_NB
+        from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_SH
     except ImportError:
         exit("ERROR: Locking is not supported on this platform.")
-    try:
-        flock(lock.fileno(), LOCK_EX | LOCK_NB)
-    except Exception:
-        exit("ERROR: Another redpill process is already running.")
+    if wait is None:
+        wait = LOCK_WAIT
+    if path in LOCKS:
+        lock_file = LOCKS[path]
+    else:
+        LOCKS[path] = lock_file = open(path, 'a')
+    if shared:
+        mode = LOCK_SH
+    else:
+        mode = LOCK_EX
+    start = time()
+    waiting = False
+    while 1:
+        try:
+            flock(lock_file.fileno(), mode | LOCK_NB)
+            return
+        except IOError, err:
+            if err.errno not in (EACCES, EAGAIN):
+                raise
+        if wait is False or (wait is not True and time() - start >= wait):
+            unlock(path)
+            exit("ERROR: Another redpill process is already running.")
+        if not waiting:
+            log("Waiting for another redpill process to release %s" % path,
+                PROGRESS)
+            waiting = True
+        sleep(0.1)
 
 def unlock(path):
     if path in LOCKS:
         LOCKS[path].close()
         del LOCKS[path]
 
-# Collate the set of resources within the given ``directory``.
-def gather_local_filelisting(directory, gathered=None):
-    if gathered is None:
-        if not isdir(directory):
-            return set()
-        gathered = set()
+@contextmanager
+def locked(path, shared=False, wait=True):
+    lock(path, shared, wait)
+    try:
+        yield
+    finally:
+        unlock(path)
+
+def get_package_lock(package):
+    mkdir(PACKAGE_LOCKS)
+    return join(PACKAGE_LOCKS, '%s.lock' % package)
+
+class Listing(object):
+    """A set of relative paths stored as a tree of interned path components.
+
+    Directories are included with a trailing slash, just like in receipts.
+    Compared to a set of full path strings, this shares the common prefixes
+    and repeated names between paths, and the difference and union of two
+    listings only needs to walk the parts of the trees where they differ. The
+    results share unchanged subtrees with their inputs, so listings shouldn't
+    be modified after they've been built.
+    """
+
+    def __init__(self, paths=()):
+        self.root = {}
+        for path in paths:
+            if path:
+                self.add(path)
+
+    def add(self, path):
+        node = self.root
+        parts = path.split('/')
+        for part in parts[:-1]:
+            child = node.get(part)
+            if child is None:
+                child = node[intern(part)] = {}
+            node = child
+        if parts[-1] not in node:
+            node[intern(parts[-1])] = None
+
+    @classmethod
+    def scan(cls, directory):
+        listing = cls()
+        if isdir(directory):
+            scan_directory(directory, listing.root)
+        return listing
+
+    def difference(self, other):
+        listing = Listing()
+        listing.root = difference_nodes(self.root, other.root)
+        return listing
+
+    def union(self, other):
+        listing = Listing()
+        listing.root = union_nodes(self.root, other.root)
+        return listing
+
+    def __contains__(self, path):
+        node = self.root
+        for part in path.split('/'):
+            if node is None or part not in node:
+                return False
+            node = node[part]
+        return node is None
+
+    def __iter__(self):
+        return iter_nodes(self.root, '')
+
+    def __len__(self):
+        return count_nodes(self.root)
+
+    def __nonzero__(self):
+        return bool(self.root)
+
+def scan_directory(directory, node):
     for item in listdir(directory):
         path = join(directory, item)
+        item = intern(item)
         if isdir(path):
-            gathered.add(path + '/')
-            gather_local_filelisting(path, gathered)
+            child = node[item] = {'': None}
+            scan_directory(path, child)
         else:
-            gathered.add(path)
-    return gathered
+            node[item] = None
+
+def difference_nodes(node, other):
+    result = {}
+    for name, child in node.iteritems():
+        if name not in other or (child is None) != (other[name] is None):
+            result[name] = child
+        elif child is not None:
+            child = difference_nodes(child, other[name])
+            if child:
+                result[name] = child
+    return result
+
+def union_nodes(node, other):
+    result = dict(node)
+    for name, child in other.iteritems():
+        existing = result.get(name)
+        if existing is None:
+            if child is not None or name not in result:
+                result[name] = child
+        elif child is not None:
+            result[name] = union_nodes(existing, child)
+    return result
+
+def iter_nodes(node, prefix):
+    for name in sorted(node):
+        child = node[name]
+        if child is None:
+            yield prefix + name
+        else:
+            for path in iter_nodes(child, prefix + name + '/'):
+                yield path
 
-# Strip the given ``prefix`` from the elements in the given ``listing`` set.
-def strip_prefix(listing, prefix):
-    new = set()
-    lead = len(prefix) + 1
-    for item in listing:
-        new.add(item[lead:])
-    return new
+def count_nodes(node):
+    return sum(
+        child is None and 1 or count_nodes(child) for child in node.itervalues()
+        )
+
+# Collate the listing of resources within the given ``directory``.
+def gather_local_filelisting(directory):
+    return Listing.scan(directory)
 
 def get_listing():
-    return strip_prefix(gather_local_filelisting(LOCAL), LOCAL)
+    with traced('listing'):
+        return gather_local_filelisting(LOCAL)
 
+# Remove everything added to the local directory since the given listing was
+# taken, deleting any new directories once they've been emptied.
 def cleanup_partial_install(current_filelisting):
-    new_filelisting = get_listing()
-    diff = new_filelisting.difference(current_filelisting)
-    for file in diff:
-        file = join(LOCAL, file)
-        remove(file)
+    diff = get_listing().difference(current_filelisting)
+    directories = []
+    for path in diff:
+        if path.endswith('/'):
+            directories.append(path)
+        else:
+            remove(join(LOCAL, path))
+    for path in sorted(directories, reverse=True):
+        path = join(LOCAL, path)
+        if isdir(path) and not listdir(path):
+            os.rmdir(path)
 
 # ------------------------------------------------------------------------------
 # Constants
@@ -317,17 +869,30 @@ INFO = join(SHARE, 'info')
 LIB = join(LOCAL, 'lib')
 MAN = join(SHARE, 'man')
 RECEIPTS = join(ENVIRON, 'receipts')
+STATE = environ.get('REDPILL_STATE', join(ENVIRON, '.redpill'))
 TMP = join(LOCAL, 'tmp')
 VAR = join(LOCAL, 'var')
 
 BUILD_WORKING_DIRECTORY = '/tmp/redpill-%s' % sha1(ENVIRON).hexdigest()[:8]
 BUILD_LOCK = BUILD_WORKING_DIRECTORY + '.lock'
+LOCAL_LOCK = BUILD_WORKING_DIRECTORY + '.local.lock'
+INSTALL_LOCK = BUILD_WORKING_DIRECTORY + '.install.lock'
+PACKAGE_LOCKS = BUILD_WORKING_DIRECTORY + '.locks'
+BUILD_LOGS = join(BUILD_WORKING_DIRECTORY, 'logs')
+
+# Distfiles are kept in the build working directory, unless a directory which
+# can be shared between environs has been specified.
+DISTFILES = environ.get('REDPILL_DISTFILES', BUILD_WORKING_DIRECTORY)
+BUILD_HISTORY = join(STATE, 'history.json')
+BUILD_TIMINGS = join(STATE, 'timings')
+MANIFEST = join(STATE, 'manifest.json')
 
 BUILD_RECIPES = [path for path in environ.get(
     'REDPILL_BUILD_RECIPES', join(ENVIRON, 'buildrecipes')
     ).split(':') if isfile(path)]
 
-DISTFILES_URL_BASE = get_conf('distfiles-url-base')
+# This is set from the config when the build recipes are initialised.
+DISTFILES_URL_BASE = None
 
 PRE_INSTALLS = [path for path in environ.get(
     'REDPILL_PRE_INSTALL', join(ENVIRON, 'preinstall')
@@ -367,12 +932,207 @@ RECIPES_INITIALISED = []
 
 DEBUG = False
 
+# ------------------------------------------------------------------------------
+# Build History
+# ------------------------------------------------------------------------------
+
+BUILD_PHASES = ['download', 'extract', 'build', 'receipt']
+SPANS = []
+TIMINGS = {}
+
+def record_timing(package, phase, duration):
+    durations = TIMINGS.setdefault(package, {})
+    durations[phase] = durations.get(phase, 0) + duration
+
+def record_span(category, start, end, name=None, package=None):
+    SPANS.append({
+        'category': category,
+        'name': name or category,
+        'package': package,
+        'start': start,
+        'end': end,
+        'thread': get_ident()
+        })
+
+# Record a span for the time spent within the block for the detailed timing
+# reports.
+@contextmanager
+def traced(category, name=None, package=None):
+    start = time()
+    try:
+        yield
+    finally:
+        record_span(category, start, time(), name, package)
+
+def traced_call(category, name, func, *args):
+    with traced(category, name):
+        return func(*args)
+
+# Accumulate the time spent within the block against the given ``phase`` of a
+# package's install.
+@contextmanager
+def timed(package, phase):
+    start = time()
+    try:
+        yield
+    finally:
+        end = time()
+        record_timing(package, phase, end - start)
+        record_span(phase, start, end, package=package)
+
+def load_build_history():
+    if not isfile(BUILD_HISTORY):
+        return {}
+    history_file = open(BUILD_HISTORY, 'rb')
+    try:
+        return decode_json(history_file.read())
+    except Exception:
+        return {}
+    finally:
+        history_file.close()
+
+# Persist the phase timings for a successfully installed package, along with
+# the versions of the packages it was built against. The history keeps the
+# latest record for each version of a package.
+def record_build_history(package, version, requires=None):
+    mkdir(STATE)
+    history = load_build_history()
+    record = dict(TIMINGS.get(package, {}))
+    record['time'] = time()
+    if requires is not None:
+        record['requires'] = requires
+    history.setdefault(package, {})[version] = record
+    tmp_path = BUILD_HISTORY + '.tmp'
+    history_file = open(tmp_path, 'wb')
+    history_file.write(encode_json(history, sort_keys=True))
+    history_file.close()
+    os.rename(tmp_path, BUILD_HISTORY)
+
+# Estimate how long installing the given package version will take, based on
+# previous runs. We fall back to the most recent record for any other version
+# of the package and return None if the package has never been built.
+def estimate_build_time(package, version, history, cached=False):
+    records = history.get(package)
+    if not records:
+        return None
+    record = records.get(version)
+    if not record:
+        record = max(records.values(), key=lambda r: r.get('time', 0))
+    return sum(
+        record.get(phase, 0) for phase in BUILD_PHASES
+        if not (cached and phase == 'download')
+        )
+
+# Return a mapping of each of the given ``packages`` to the ones amongst them
+# which directly require it.
+def get_dependents(packages):
+    packages = set(packages)
+    dependents = {}
+    for package in packages:
+        recipe = RECIPES[package][PACKAGES[package][0]]
+        for dep in packages.intersection(recipe.get('requires', [])):
+            dependents.setdefault(dep, set()).add(package)
+    return dependents
+
+# Return the cost of the longest chain of dependent builds starting at each of
+# the given ``packages``, i.e. the package's own estimate plus the most costly
+# chain of packages which need it. Schedulers should favour the packages with
+# the highest chain cost so that the critical path is started first.
+def get_chain_costs(packages, estimates):
+    dependents = get_dependents(packages)
+    costs = {}
+    def get_cost(package):
+        if package not in costs:
+            costs[package] = estimates.get(package) or 0
+            costs[package] += max(
+                [get_cost(dep) for dep in dependents.get(package, [])] or [0]
+                )
+        return costs[package]
+    for package in packages:
+        get_cost(package)
+    return costs
+
+# Write out a JSON report of the spans recorded during the current run and,
+# optionally, a trace file which can be loaded into Chrome's about:tracing.
+def write_timing_report(start, status, trace=None, keep=100):
+    end = time()
+    summary = {}
+    for span in SPANS:
+        if span['package']:
+            phases = summary.setdefault(span['package'], {})
+            phases[span['category']] = (
+                phases.get(span['category'], 0) + span['end'] - span['start']
+                )
+    report = {
+        'command': sys.argv[1:],
+        'duration': end - start,
+        'end': end,
+        'packages': summary,
+        'spans': SPANS,
+        'start': start,
+        'status': status
+        }
+    mkdir(BUILD_TIMINGS)
+    filename = '%s-%d.json' % (
+        strftime('%Y%m%d-%H%M%S', localtime(start)), os.getpid()
+        )
+    report_file = open(join(BUILD_TIMINGS, filename), 'wb')
+    report_file.write(encode_json(report))
+    report_file.close()
+    for old in sorted(listdir(BUILD_TIMINGS))[:-keep]:
+        remove(join(BUILD_TIMINGS, old))
+    if trace:
+        events = []
+        pid = os.getpid()
+        for span in SPANS:
+            args = {}
+            if span['package']:
+                args['package'] = span['package']
+            events.append({
+                'args': args,
+                'cat': span['category'],
+                'dur': int((span['end'] - span['start']) * 1000000),
+                'name': span['name'],
+                'ph': 'X',
+                'pid': pid,
+                'tid': span['thread'],
+                'ts': int((span['start'] - start) * 1000000)
+                })
+        trace_file = open(trace, 'wb')
+        trace_file.write(encode_json({'traceEvents': events}))
+        trace_file.close()
+
+def load_timing_reports(last=10):
+    if not isdir(BUILD_TIMINGS):
+        return []
+    reports = []
+    for filename in sorted(listdir(BUILD_TIMINGS))[-last:]:
+        report_file = open(join(BUILD_TIMINGS, filename), 'rb')
+        try:
+            reports.append(decode_json(report_file.read()))
+        except Exception:
+            pass
+        report_file.close()
+    return reports
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    if seconds < 60:
+        return '%.1fs' % seconds
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes < 60:
+        return '%dm %02ds' % (minutes, seconds)
+    hours, minutes = divmod(minutes, 60)
+    return '%dh %02dm' % (hours, minutes)
+
 # ------------------------------------------------------------------------------
 # Distfiles Downloader
 # ------------------------------------------------------------------------------
 
 DOWNLOAD_QUEUE = []
 DOWNLOAD_ERROR = []
+DOWNLOAD_POOL = TaskPool(limit=int(environ.get('REDPILL_DOWNLOAD_JOBS', 4)))
 
 class DownloadError(Exception):
     def __init__(self, msg):
@@ -381,43 +1141,676 @@ class DownloadError(Exception):
 # Download the given distfile and ensure it has a matching digest. We try to
 # capture and exit on all errors to avoid them being silently ignored in a
 # separate thread.
-def _download_distfile(distfile, url, hash, dest):
+def _download_distfile(distfile, url, hash, dest, package=None):
+    start = time()
+    tmp_path = '%s.%d.part' % (dest, os.getpid())
     try:
+        emit('download_start', distfile=distfile, package=package, url=url)
         try:
-            distfile_source = urlopen(url).content
+            with traced('download', distfile, package):
+                size, digest = stream_download(url, tmp_path, distfile, package)
         except Exception:
             raise DownloadError("Failed to download %s" % distfile)
-        if sha256(distfile_source).hexdigest() != hash:
+        if digest != hash:
             raise DownloadError("Got an invalid hash digest for %s" % distfile)
         try:
-            distfile_file = open(dest, 'wb')
-            distfile_file.write(distfile_source)
-            distfile_file.close()
+            os.rename(tmp_path, dest)
         except Exception:
             raise DownloadError("Writing %s" % distfile)
+        duration = time() - start
+        record_timing(package or distfile, 'download', duration)
+        emit(
+            'download_finish', bytes=size, distfile=distfile,
+            duration=duration, package=package,
+            throughput=size / max(duration, 0.001)
+            )
         DOWNLOAD_QUEUE.pop()
     except DownloadError, errmsg:
+        if isfile(tmp_path):
+            remove(tmp_path)
+        emit(
+            'download_error', distfile=distfile, message=errmsg.msg,
+            package=package
+            )
         DOWNLOAD_QUEUE.pop()
         DOWNLOAD_ERROR.append(errmsg)
 
-# Check if there's an existing valid download. If not, fire off a fresh download
-# in a separate thread if the ``fork`` parameter has been set.
-def download_distfile(distfile, url, hash, fork=False):
-    dest = join(BUILD_WORKING_DIRECTORY, distfile)
+# Stream the response for the given ``url`` to ``path`` whilst hashing it, so
+# that large distfiles don't need to be held in memory. Progress events are
+# emitted at most every ``DOWNLOAD_PROGRESS_INTERVAL`` seconds.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_PROGRESS_INTERVAL = 1.0
+
+def stream_download(url, path, distfile, package):
+    response = urlopen(url, stream=True)
+    try:
+        response.raise_for_status()
+        total = int(response.headers.get('content-length') or 0) or None
+        digest = sha256()
+        size = 0
+        start = last = time()
+        output = open(path, 'wb')
+        try:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                output.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                now = time()
+                if EVENTS and now - last >= DOWNLOAD_PROGRESS_INTERVAL:
+                    emit(
+                        'download_progress', bytes=size, distfile=distfile,
+                        package=package, throughput=size / (now - start),
+                        total=total
+                        )
+                    last = now
+        finally:
+            output.close()
+    finally:
+        response.close()
+    return size, digest.hexdigest()
+
+# Return the distfile for the given package ``version`` along with the URL to
+# download it from.
+def get_distfile(package, version, info):
+    distfile = info['distfile'] % {'name': package, 'version': version}
+    if distfile:
+        url = (info['distfile_url_base'] or DISTFILES_URL_BASE) + distfile
+    else:
+        url = ''
+    return distfile, url
+
+# Check if there's an existing valid download and, if not, fire off a fresh
+# download. If the ``fork`` parameter has been set, this all happens within a
+# task on the ``DOWNLOAD_POOL`` and the task is returned. If ``hold`` is set, a
+# shared lock on the distfile is kept on return, so that it can't be garbage
+# collected by another redpill process before the build has finished with it.
+def download_distfile(
+    distfile, url, hash, fork=False, package=None, hold=False
+    ):
+    if fork:
+        return DOWNLOAD_POOL.spawn(
+            download_distfile, distfile, url, hash, package=package,
+            hold=hold, task_name=distfile
+            )
+    dest = join(DISTFILES, distfile)
+    while 1:
+        # The distfile is locked so that redpill processes sharing the
+        # distfiles directory only download it once.
+        with locked(dest + '.lock'):
+            fetch_distfile(distfile, url, hash, dest, package)
+        if not hold:
+            return
+        # The lock is briefly released before the shared one is taken, so we
+        # check that the distfile wasn't evicted in the meantime.
+        lock(dest + '.lock', shared=True, wait=True)
+        if isfile(dest):
+            return
+        unlock(dest + '.lock')
+        if DOWNLOAD_ERROR:
+            return
+
+def release_distfile(distfile):
+    unlock(join(DISTFILES, distfile) + '.lock')
+
+def fetch_distfile(distfile, url, hash, dest, package):
     if isfile(dest):
         log("Verifying existing %s" % distfile, PROGRESS)
-        distfile_file = open(dest, 'rb')
-        distfile_source = distfile_file.read()
-        distfile_file.close()
-        if sha256(distfile_source).hexdigest() == hash:
+        start = time()
+        with traced('verify', distfile, package):
+            distfile_file = open(dest, 'rb')
+            distfile_source = distfile_file.read()
+            distfile_file.close()
+            valid = sha256(distfile_source).hexdigest() == hash
+        record_timing(package or distfile, 'download', time() - start)
+        if valid:
+            # Touch the distfile so that it's seen as recently used when the
+            # working directory is garbage collected.
+            os.utime(dest, None)
+            emit(
+                'cache_hit', distfile=distfile, kind='distfile',
+                package=package
+                )
             return
         remove(dest)
     log("Downloading %s" % distfile, PROGRESS)
     DOWNLOAD_QUEUE.append(distfile)
-    if fork:
-        start_new_thread(_download_distfile, (distfile, url, hash, dest))
-    else:
-        _download_distfile(distfile, url, hash, dest)
+    _download_distfile(distfile, url, hash, dest, package)
+
+# ------------------------------------------------------------------------------
+# Build Tree Cache
+# ------------------------------------------------------------------------------
+
+# Unpacked build trees can be kept after a successful install, so that when a
+# package is rebuilt from the same distfile, e.g. with different config flags,
+# the existing objects can be reused instead of compiling everything again.
+# As trees are keyed by the distfile's hash, a version bump, even a patch-level
+# one, always unpacks a fresh tree. This is opted into by setting a size cap,
+# e.g. ``2G``, with the ``keep-build-trees`` config value or the
+# ``$REDPILL_KEEP_BUILD_TREES`` environment variable. Once the cap is exceeded,
+# the least recently kept trees are evicted.
+BUILD_TREES = join(BUILD_WORKING_DIRECTORY, 'trees')
+BUILD_TREES_LOCK = BUILD_TREES + '.lock'
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(value):
+    size = str(value).strip().upper().rstrip('B')
+    try:
+        if size and size[-1] in SIZE_UNITS:
+            return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+        return int(size)
+    except ValueError:
+        exit("ERROR: Invalid size: %r" % value)
+
+def get_build_tree_cap():
+    value = environ.get(
+        'REDPILL_KEEP_BUILD_TREES', get_conf('keep-build-trees', None)
+        )
+    if not value:
+        return 0
+    return parse_size(value)
+
+def get_directory_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+# Move the kept build tree for the distfile with the given ``hash`` into place
+# as ``package`` within the current directory, returning whether there was one.
+def restore_build_tree(package, hash):
+    entry = join(BUILD_TREES, hash)
+    with locked(BUILD_TREES_LOCK):
+        if not isdir(join(entry, package)):
+            return False
+        os.rename(join(entry, package), package)
+        rmdir(entry)
+    emit('cache_hit', kind='build_tree', package=package)
+    log("Reusing the kept build tree for %s" % package, PROGRESS)
+    return True
+
+# Keep the build tree for ``package`` within the current directory, evicting the
+# least recently kept trees if the total size goes over the ``cap``.
+def keep_build_tree(package, hash, cap):
+    size = get_directory_size(package)
+    if size > cap:
+        rmdir(package)
+        return
+    entry = join(BUILD_TREES, hash)
+    with locked(BUILD_TREES_LOCK):
+        rmdir(entry)
+        mkdir(entry)
+        size_file = open(join(entry, '.size'), 'wb')
+        size_file.write(str(size))
+        size_file.close()
+        os.rename(package, join(entry, package))
+        evict_build_trees(cap)
+
+def evict_build_trees(cap):
+    entries = []
+    for name in listdir(BUILD_TREES):
+        entry = join(BUILD_TREES, name)
+        try:
+            size = int(read_file(join(entry, '.size')))
+            mtime = stat(entry).st_mtime
+        except (IOError, OSError, ValueError):
+            rmdir(entry)
+            continue
+        entries.append((mtime, size, entry))
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, entry in sorted(entries):
+        if total <= cap:
+            break
+        log("Evicting the kept build tree %s" % entry, PROGRESS)
+        rmdir(entry)
+        total -= size
+
+# ------------------------------------------------------------------------------
+# Shared Builds
+# ------------------------------------------------------------------------------
+
+# When several environs are built in one run, identical package builds are only
+# done once. Builds are identified by their recipe hash, i.e. a hash of the
+# resolved recipe with the paths of the environ normalised away, along with the
+# recipe hashes of the packages it requires. The first environ to build one
+# stores the installed files as an artifact within ``$REDPILL_ARTIFACTS``,
+# whilst the others wait for it and install the artifact, relocated to their
+# own prefix. Only distfile builds whose commands come from redpill itself are
+# shared, as anything else can depend on the environ in unknown ways.
+ARTIFACTS = environ.get('REDPILL_ARTIFACTS')
+ARTIFACT_METADATA = 'artifact.json'
+SHARED_BUILD_TYPES = ('default', 'jar')
+
+def normalise_recipe_value(value):
+    if isinstance(value, basestring):
+        return value.replace(LOCAL, '$PREFIX').replace(ENVIRON, '$ENVIRON')
+    if isinstance(value, (list, tuple)):
+        return [normalise_recipe_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict(
+            (key, normalise_recipe_value(item))
+            for key, item in value.iteritems()
+            )
+    if hasattr(value, '__call__'):
+        code = getattr(value, 'func_code', None)
+        if code is None or code.co_filename != REDPILL_SOURCE:
+            raise ValueError("Can't share builds which call %r" % value)
+        return code.co_name
+    return value
+
+REDPILL_SOURCE = normalise_recipe_value.func_code.co_filename
+
+# Return the recipe hash of the given package's build, or None if it can't be
+# shared.
+def get_recipe_hash(package, hashes=None):
+    if hashes is None:
+        hashes = {}
+    if package in hashes:
+        return hashes[package]
+    hashes[package] = None
+    version = TO_INSTALL.get(package) or PACKAGES[package][0]
+    recipe = RECIPES[package][version]
+    build_type = recipe.get('type', 'default')
+    info = BUILD_TYPES[build_type].copy()
+    info.update(recipe)
+    if build_type not in SHARED_BUILD_TYPES or not info.get('hash'):
+        return None
+    requires = [
+        get_recipe_hash(dep, hashes)
+        for dep in sorted(recipe.get('requires', []))
+        ]
+    if None in requires:
+        return None
+    try:
+        data = encode_json([
+            PLATFORM, package, version, normalise_recipe_value(info), requires
+            ], sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    hashes[package] = sha256(data).hexdigest()
+    return hashes[package]
+
+# Copy the entries of ``listing`` from within ``source`` to ``destination``,
+# skipping anything beneath a symlink so that nothing is written outside of it.
+def copy_listing(listing, source, destination):
+    from shutil import copy2
+    real_destination = os.path.realpath(destination)
+    for relpath in sorted(listing):
+        path = join(source, relpath.rstrip('/'))
+        dest = join(destination, relpath.rstrip('/'))
+        parent = os.path.realpath(dirname(dest))
+        if parent != real_destination and not parent.startswith(
+            real_destination + '/'
+            ):
+            continue
+        if islink(path):
+            mkdir(dirname(dest))
+            if islink(dest) or isfile(dest):
+                remove(dest)
+            os.symlink(os.readlink(path), dest)
+        elif isdir(path):
+            mkdir(dest)
+        elif isfile(path):
+            mkdir(dirname(dest))
+            # Files are replaced instead of being written over, as they may be
+            # hardlinked into another generation.
+            if islink(dest) or isfile(dest):
+                remove(dest)
+            copy2(path, dest)
+
+# Store the files from the given receipt ``listing`` as the artifact at
+# ``path``.
+def store_artifact(path, listing):
+    tmp_path = '%s.%d' % (path, os.getpid())
+    rmdir(tmp_path)
+    root = join(tmp_path, 'local')
+    mkdir(root)
+    copy_listing(listing, LOCAL, root)
+    metadata = encode_json({
+        'listing': sorted(listing),
+        'prefix': LOCAL,
+        'relocations': find_relocations(root, LOCAL)
+        }, sort_keys=True)
+    metadata_file = open(join(tmp_path, ARTIFACT_METADATA), 'wb')
+    metadata_file.write(metadata)
+    metadata_file.close()
+    os.rename(tmp_path, path)
+
+# Install the artifact at ``path`` into the local directory, returning False if
+# its binaries can't be relocated to our prefix.
+def install_artifact(path):
+    metadata = decode_json(read_file(join(path, ARTIFACT_METADATA)))
+    old = metadata['prefix'].encode('utf-8')
+    relocations = dict(
+        (kind, [relpath.encode('utf-8') for relpath in paths])
+        for kind, paths in metadata['relocations'].iteritems()
+        )
+    if old != LOCAL and len(LOCAL) > len(old) and relocations['binary']:
+        return False
+    listing = [relpath.encode('utf-8') for relpath in metadata['listing']]
+    copy_listing(listing, join(path, 'local'), LOCAL)
+    if old != LOCAL:
+        relocate(LOCAL, old, LOCAL, relocations)
+    return True
+
+# Install ``package`` from the shared build at ``path``, returning whether it
+# could be used.
+def install_shared_build(package, version, path):
+    with locked(INSTALL_LOCK):
+        current_filelisting = get_listing()
+        if not install_artifact(path):
+            log("Can't relocate the shared build of %s, so building it" % (
+                package
+                ), PROGRESS)
+            return False
+        with locked(LOCAL_LOCK):
+            receipt_data = get_listing().difference(current_filelisting)
+            write_receipt(package, version, receipt_data)
+            get_installed_packages()[package] = version
+    emit('cache_hit', kind='shared_build', package=package)
+    log("Installed %s %s from a shared build" % (package, version), SUCCESS)
+    return True
+
+# ------------------------------------------------------------------------------
+# Admission Control
+# ------------------------------------------------------------------------------
+
+# Recipes can declare the number of ``cpu`` cores and the amount of ``memory``
+# that building them needs. Builds from all the redpill processes on a machine
+# are recorded in a shared ledger and a build is only admitted once its cost
+# fits within the limits, alongside the builds which are already running, the
+# load average and the available memory. Otherwise it's queued until it fits.
+# A build is always admitted if nothing else is running, so that recipes which
+# need more than the limits can still be built. The ledger is per user, as the
+# files of other users can't be replaced within /tmp, and if it can't be used
+# at all, builds are admitted without it.
+ADMISSION_LEDGER = environ.get(
+    'REDPILL_ADMISSION_LEDGER', '/tmp/redpill-admission-%d.json' % os.getuid()
+    )
+ADMISSION_LOCK = ADMISSION_LEDGER + '.lock'
+ADMISSION_POLL = 2
+ADMISSION_ERRORS = []
+
+def disable_admission(err):
+    if not ADMISSION_ERRORS:
+        log("Admitting builds without the ledger at %s: %s" % (
+            ADMISSION_LEDGER, err
+            ), ERROR)
+    ADMISSION_ERRORS.append(err)
+
+def get_available_memory():
+    try:
+        meminfo = open('/proc/meminfo', 'rb')
+    except IOError:
+        return None
+    try:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    finally:
+        meminfo.close()
+
+def get_admission_limits():
+    cpu = environ.get('REDPILL_MAX_CPU', get_conf('max-build-cpu', None))
+    memory = environ.get(
+        'REDPILL_MAX_MEMORY', get_conf('max-build-memory', None)
+        )
+    return (
+        cpu and float(cpu) or NUMBER_OF_CPUS, memory and parse_size(memory)
+        )
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno == EPERM
+    return True
+
+def read_admission_ledger():
+    entries = []
+    if isfile(ADMISSION_LEDGER):
+        try:
+            entries = decode_json(read_file(ADMISSION_LEDGER))
+        except Exception:
+            pass
+    return [entry for entry in entries if is_running(entry['pid'])]
+
+def write_admission_ledger(entries):
+    tmp_path = '%s.%d' % (ADMISSION_LEDGER, os.getpid())
+    ledger = open(tmp_path, 'wb')
+    ledger.write(encode_json(entries))
+    ledger.close()
+    os.rename(tmp_path, ADMISSION_LEDGER)
+
+# Return the reason for not admitting a build with the given cost, or None if
+# it can be admitted.
+def check_admission(entries, cpu, memory, limits):
+    if not entries:
+        return None
+    max_cpu, max_memory = limits
+    used_cpu = sum(entry['cpu'] for entry in entries)
+    used_memory = sum(entry['memory'] for entry in entries)
+    load = os.getloadavg()[0]
+    if max(used_cpu, load) + cpu > max_cpu:
+        return "needs %s cpu with %s in use and a load of %.2f (limit %s)" % (
+            cpu, used_cpu, load, max_cpu
+            )
+    if max_memory and used_memory + memory > max_memory:
+        return "needs %s memory with %s reserved (limit %s)" % (
+            format_size(memory), format_size(used_memory),
+            format_size(max_memory)
+            )
+    available = memory and get_available_memory()
+    if available is not None and memory > available:
+        return "needs %s memory with %s available" % (
+            format_size(memory), format_size(available)
+            )
+
+def format_size(size):
+    for unit in ['T', 'G', 'M', 'K']:
+        if size >= SIZE_UNITS[unit]:
+            return '%.1f%s' % (size / float(SIZE_UNITS[unit]), unit)
+    return '%dB' % size
+
+# Wait until building ``package`` is admitted and record it in the ledger.
+def admit_build(package, info):
+    cpu = float(info['cpu'])
+    memory = info['memory'] and parse_size(info['memory']) or 0
+    limits = get_admission_limits()
+    queued = None
+    while 1:
+        if ADMISSION_ERRORS:
+            return
+        try:
+            with locked(ADMISSION_LOCK):
+                entries = read_admission_ledger()
+                reason = check_admission(entries, cpu, memory, limits)
+                if reason is None:
+                    entries.append({
+                        'cpu': cpu, 'memory': memory, 'package': package,
+                        'pid': os.getpid(), 'start': time()
+                        })
+                    write_admission_ledger(entries)
+                    break
+        except (IOError, OSError), err:
+            disable_admission(err)
+            return
+        if reason != queued:
+            log("Queueing %s: %s" % (package, reason), PROGRESS)
+            queued = reason
+        sleep(ADMISSION_POLL)
+    if queued or cpu > 1 or memory:
+        log("Admitted %s with %s cpu and %s memory alongside %d builds" % (
+            package, cpu, format_size(memory), len(entries) - 1
+            ), PROGRESS)
+
+# Remove the entry for ``package`` from the ledger, or all of the entries for
+# this process if no ``package`` is given.
+def release_build(package=None):
+    if ADMISSION_ERRORS or not isfile(ADMISSION_LEDGER):
+        return
+    pid = os.getpid()
+    try:
+        with locked(ADMISSION_LOCK):
+            entries = [
+                entry for entry in read_admission_ledger()
+                if not (
+                    entry['pid'] == pid and package in (None, entry['package'])
+                    )
+                ]
+            write_admission_ledger(entries)
+    except (IOError, OSError), err:
+        disable_admission(err)
+
+# ------------------------------------------------------------------------------
+# Working Directory GC
+# ------------------------------------------------------------------------------
+
+# The build working directory is garbage collected after each build to keep it
+# under the size cap set by the ``working-directory-cap`` config value or the
+# ``$REDPILL_WORKING_DIRECTORY_CAP`` environment variable. Partial downloads
+# and the trees left unpacked by failed builds are always removed. Then, whilst
+# it's over the cap, the least recently used distfiles which no recipe refers to
+# are evicted, followed by build logs, cached extensions and kept build trees,
+# and finally the least recently used distfiles which are still referenced.
+GC_DIRECTORIES = ('extensions', 'logs', 'trees')
+
+def get_working_directory_cap():
+    value = environ.get(
+        'REDPILL_WORKING_DIRECTORY_CAP',
+        get_conf('working-directory-cap', None)
+        )
+    if not value:
+        return None
+    return parse_size(value)
+
+# Lock the given ``path`` if it isn't already locked, returning whether it was.
+def try_lock(path):
+    from fcntl import flock, LOCK_EX, LOCK_NB
+    if path in LOCKS:
+        return False
+    lock_file = open(path, 'a')
+    try:
+        flock(lock_file.fileno(), LOCK_EX | LOCK_NB)
+    except IOError:
+        lock_file.close()
+        return False
+    LOCKS[path] = lock_file
+    return True
+
+def get_referenced_distfiles():
+    init_build_recipes()
+    distfiles = set()
+    for package, recipes in RECIPES.iteritems():
+        for version, recipe in recipes.iteritems():
+            info = BUILD_TYPES[recipe.get('type', 'default')].copy()
+            info.update(recipe)
+            distfile = get_distfile(package, version, info)[0]
+            if distfile:
+                distfiles.add(distfile)
+    return distfiles
+
+def get_path_size(path):
+    if isdir(path) and not islink(path):
+        return get_directory_size(path)
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return 0
+
+# Return the package for the given build log name, which is of the form
+# ``<package>-<version>.log``. As both can contain hyphens, we look for the
+# longest matching package name.
+def get_log_package(name):
+    matches = [
+        package for package in RECIPES if name.startswith(package + '-')
+        ]
+    if matches:
+        return max(matches, key=len)
+
+# Return the candidates for eviction as (priority, mtime, size, path, lock)
+# tuples, where ``lock`` needs to be held whilst removing the path.
+def get_gc_candidates(referenced):
+    candidates = []
+    def add(priority, path, lock=None):
+        try:
+            mtime = os.lstat(path).st_mtime
+        except OSError:
+            return
+        candidates.append((priority, mtime, get_path_size(path), path, lock))
+    if DISTFILES == BUILD_WORKING_DIRECTORY:
+        for name in listdir(DISTFILES):
+            path = join(DISTFILES, name)
+            if name.endswith('.lock') or not isfile(path):
+                continue
+            if name.endswith('.part'):
+                # Partial downloads are only evicted once their owner has
+                # exited or the lock on the distfile is free.
+                dest, pid, _ = path.rsplit('.', 2)
+                if pid.isdigit() and not is_running(int(pid)):
+                    add(0, path)
+                else:
+                    add(0, path, dest + '.lock')
+            else:
+                add(name in referenced and 3 or 1, path, path + '.lock')
+    for name in listdir(BUILD_WORKING_DIRECTORY):
+        path = join(BUILD_WORKING_DIRECTORY, name)
+        if name in RECIPES and name not in GC_DIRECTORIES and isdir(path):
+            add(0, path, get_package_lock(name))
+    if isdir(BUILD_LOGS):
+        # Logs are written to whilst the package lock is held, so that the log
+        # of a build which is still running isn't removed.
+        for name in listdir(BUILD_LOGS):
+            package = get_log_package(name)
+            if package:
+                add(2, join(BUILD_LOGS, name), get_package_lock(package))
+            else:
+                add(2, join(BUILD_LOGS, name))
+    if isdir(PYTHON_EXTENSIONS):
+        for name in listdir(PYTHON_EXTENSIONS):
+            add(2, join(PYTHON_EXTENSIONS, name))
+    if isdir(BUILD_TREES):
+        for name in listdir(BUILD_TREES):
+            add(2, join(BUILD_TREES, name), BUILD_TREES_LOCK)
+    return sorted(candidates)
+
+# Remove garbage from the build working directory until it's under the ``cap``,
+# returning the number of bytes reclaimed. Without a cap, only the partial
+# downloads, failed build trees and unreferenced distfiles are removed.
+def collect_garbage(cap=None, dry_run=False):
+    if not isdir(BUILD_WORKING_DIRECTORY):
+        return 0
+    candidates = get_gc_candidates(get_referenced_distfiles())
+    total = get_directory_size(BUILD_WORKING_DIRECTORY)
+    reclaimed = removed = 0
+    for priority, mtime, size, path, lock in candidates:
+        if priority > 1 or (priority == 1 and cap is not None):
+            if cap is None or total <= cap:
+                break
+        if lock and not try_lock(lock):
+            continue
+        try:
+            log("%s %s (%s)" % (
+                dry_run and "Would remove" or "Removing", path,
+                format_size(size)
+                ), PROGRESS)
+            if not dry_run:
+                if isdir(path) and not islink(path):
+                    rmdir(path)
+                else:
+                    remove(path)
+        finally:
+            if lock:
+                unlock(lock)
+        total -= size
+        reclaimed += size
+        removed += 1
+    emit('gc', reclaimed=reclaimed, removed=removed, size=total)
+    return reclaimed
 
 # ------------------------------------------------------------------------------
 # Instance Roles
@@ -429,6 +1822,8 @@ def load_role(role):
 
     init_build_recipes()
     if role in ROLES:
+        for package in ROLES[role]:
+            install_package(package)
         return ROLES[role]
 
     for path in ROLES_PATH:
@@ -463,74 +1858,137 @@ def load_role(role):
 def get_dependencies(package, gathered=None):
     if gathered is None:
         gathered = set()
-    else:
-        gathered.add(package)
     recipe = RECIPES[package][PACKAGES[package][0]]
     for dep in recipe.get('requires', []):
-        get_dependencies(dep, gathered)
+        if dep not in gathered:
+            gathered.add(dep)
+            get_dependencies(dep, gathered)
     return gathered
 
 # ------------------------------------------------------------------------------
 # Checkers
 # ------------------------------------------------------------------------------
 
+# Probing the toolchain means spawning each binary, which can be slow, e.g. for
+# the JVM. So the detected versions are cached by the resolved path of the
+# binary along with its mtime and inode, and are only probed again when the
+# binary changes.
+TOOLCHAIN = ['gcc', 'git', 'java', 'node', 'ruby']
+TOOLCHAIN_CACHE = join(STATE, 'toolchain.json')
+TOOLCHAIN_LOCK = Lock()
+TOOLCHAIN_VERSIONS = {}
+
+def find_executable(name):
+    if '/' in name:
+        paths = [name]
+    else:
+        paths = [
+            join(directory, name)
+            for directory in environ.get('PATH', '').split(os.pathsep)
+            ]
+    for path in paths:
+        if isfile(path) and os.access(path, os.X_OK):
+            return os.path.realpath(path)
+
+def load_toolchain_cache():
+    if not TOOLCHAIN_VERSIONS and isfile(TOOLCHAIN_CACHE):
+        try:
+            TOOLCHAIN_VERSIONS.update(decode_json(read_file(TOOLCHAIN_CACHE)))
+        except Exception:
+            pass
+    return TOOLCHAIN_VERSIONS
+
+# Return the version of the given ``binary`` by running it with ``args`` and
+# calling ``parse`` on its stdout and stderr. This returns None if the binary
+# couldn't be found or its version couldn't be parsed.
+def probe_version(binary, args, parse):
+    path = find_executable(binary)
+    if not path:
+        return None
+    info = stat(path)
+    key = [path, info.st_mtime, info.st_ino] + args
+    with TOOLCHAIN_LOCK:
+        cached = load_toolchain_cache().get(binary)
+    if cached and cached['key'] == key:
+        return cached['version']
+    try:
+        version = parse(*run_command([path] + args, reterror=True))
+    except Exception:
+        return None
+    with TOOLCHAIN_LOCK:
+        TOOLCHAIN_VERSIONS[binary] = {
+            'key': key, 'path': path, 'version': version
+            }
+        try:
+            mkdir(STATE)
+            tmp_path = '%s.%d.%d' % (TOOLCHAIN_CACHE, os.getpid(), get_ident())
+            cache_file = open(tmp_path, 'wb')
+            cache_file.write(encode_json(TOOLCHAIN_VERSIONS, sort_keys=True))
+            cache_file.close()
+            os.rename(tmp_path, TOOLCHAIN_CACHE)
+        except Exception:
+            pass
+    return version
+
+def get_gcc_version():
+    return probe_version(
+        environ.get('CC', 'gcc'), ['-dumpversion'],
+        lambda out, err: out.strip()
+        )
+
+def get_git_version():
+    return probe_version(
+        'git', ['--version'], lambda out, err: out.splitlines()[0].split()[2]
+        )
+
+def get_java_version():
+    return probe_version(
+        'java', ['-version'],
+        lambda out, err: err.splitlines()[0].split()[-1][1:-1]
+        )
+
+def get_node_version():
+    return probe_version(
+        'node', ['-v'], lambda out, err: out[1:].strip()
+        )
+
+def get_ruby_version():
+    return probe_version(
+        'ruby', ['-v'], lambda out, err: out.strip().split()[1].strip()
+        )
+
+def parse_version(version):
+    return tuple(map(int, version.split('.')))
+
 def ensure_gcc_version(version=(4, 0)):
-    gcc = environ.get('CC', 'gcc')
     try:
-        ver = do(
-            gcc, '-dumpversion', redirect_stdout=True, reterror=True
-            )
-        ver = tuple(map(int, ver[0].strip().split('.')))
-        if ver < version:
+        if parse_version(get_gcc_version()) < version:
             raise RuntimeError("Invalid version")
     except Exception:
         exit('ERROR: GCC %s+ not found!' % '.'.join(map(str, version)))
 
 def ensure_git_version(version=(1, 7)):
     try:
-        ver = do(
-            'git', '--version', redirect_stdout=True,
-            redirect_stderr=True, reterror=True
-            )
-        ver = ver[0].splitlines()[0].split()[2]
-        ver = tuple(int(part) for part in ver.split('.'))
-        if ver < version:
+        if parse_version(get_git_version()) < version:
             raise RuntimeError("Invalid version")
     except Exception:
         exit('ERROR: Git %s+ not found!' % '.'.join(map(str, version)))
 
 def ensure_java_version(version=(1, 6), title='Java 6+ runtime'):
-    try:
-        ver = do(
-            'java', '-version', redirect_stdout=True,
-            redirect_stderr=True, reterror=True
-            )
-        ver = ver[1].splitlines()[0].split()[-1][1:-1]
-        if not ver >= '.'.join(map(str, version)):
-            raise RuntimeError("Invalid version")
-    except Exception:
+    ver = get_java_version()
+    if not (ver and ver >= '.'.join(map(str, version))):
         exit('ERROR: %s not found!' % title)
 
 def ensure_node_version(version=(0, 8, 2)):
     try:
-        ver = do(
-            'node', '-v', redirect_stdout=True,
-            redirect_stderr=True, reterror=True
-            )
-        ver = tuple(map(int, ver[0][1:].strip().split('.')))
-        if ver < version:
+        if parse_version(get_node_version()) < version:
             raise RuntimeError("Invalid version")
     except Exception:
         exit('ERROR: Node.js %s+ not found!' % '.'.join(map(str, version)))
 
 def ensure_ruby_version(version=(1, 8, 7)):
     try:
-        ver = do(
-            'ruby', '-v', redirect_stdout=True,
-            redirect_stderr=True, reterror=True
-            )
-        ver = tuple(map(int, ver[0].strip().split()[1].strip().split('.')))
-        if ver < version:
+        if parse_version(get_ruby_version()) < version:
             raise RuntimeError("Invalid version")
     except Exception:
         exit('ERROR: Ruby %s+ not found!' % '.'.join(map(str, version)))
@@ -540,13 +1998,36 @@ def ensure_ruby_version(version=(1, 8, 7)):
 # ------------------------------------------------------------------------------
 
 def init_build_recipes():
+    global DISTFILES_URL_BASE
+    # Commands take the appropriate lock on the environ themselves, but we make
+    # sure that at least a shared lock is held, e.g. to avoid a concurrent nuke.
+    # This is done even if the recipes have already been resolved, as the
+    # daemon keeps them in memory across commands.
+    if BUILD_LOCK not in LOCKS:
+        lock(BUILD_LOCK, shared=True)
     if RECIPES_INITIALISED:
         return
-    # Try getting a lock to avoid concurrent builds.
-    lock(BUILD_LOCK)
     mkdir(RECEIPTS)
+    DISTFILES_URL_BASE = get_conf('distfiles-url-base')
+    # The recipes are executed within our globals, so make sure that the lazily
+    # imported modules are available to them too.
+    import subprocess, tarfile
+    BUILTINS.update({'subprocess': subprocess, 'tarfile': tarfile})
     for recipe in BUILD_RECIPES:
         execfile(recipe, BUILTINS)
+    # Query the HEAD of all git checkouts concurrently.
+    pool = TaskPool()
+    heads = {}
+    for package in RECIPES:
+        for recipe in RECIPES[package]:
+            if recipe.get('type') == 'git':
+                path = join(ENVIRON, recipe['path'])
+                if path not in heads:
+                    heads[path] = pool.spawn(
+                        run_command, ['git', 'rev-parse', 'HEAD'], cwd=path,
+                        exit_on_error=True
+                        )
+    pool.wait()
     for package in list(RECIPES):
         recipes = RECIPES[package]
         versions = []
@@ -555,43 +2036,9 @@ def init_build_recipes():
             recipe_type = recipe.get('type')
             if recipe_type == 'git':
                 path = join(ENVIRON, recipe['path'])
-                version = run_command(
-                    ['git', 'rev-parse', 'HEAD'], cwd=path, exit_on_error=True
-                    ).strip()
+                version = heads[path].result.strip()
             elif 'depends' in recipe:
-                contents = {}
-                latest = 0
-                for pattern in recipe['depends']:
-                    for file in glob(pattern):
-                        dep_file = open(file, 'rb')
-                        contents[file] = dep_file.read()
-                        dep_file.close()
-                        dep_mtime = stat(file)[ST_MTIME]
-                        if dep_mtime > latest:
-                            latest = dep_mtime
-                generate = 0
-                for pattern in recipe['outputs']:
-                    files = glob(pattern)
-                    if not files:
-                        generate = 1
-                        break
-                    for file in files:
-                        if not isfile(file):
-                            generate = 1
-                            break
-                        if stat(file)[ST_MTIME] <= latest:
-                            generate = 1
-                            break
-                    if generate:
-                        break
-                if generate:
-                    for file in listdir(RECEIPTS):
-                        if file.startswith(package + '-'):
-                            remove(join(RECEIPTS, file))
-                version = sha1(''.join([
-                    '%s\x00%s' % (f, contents[f])
-                    for f in sorted(contents)
-                    ])).hexdigest()
+                version = get_depends_version(recipe)
             else:
                 version = recipe['version']
             versions.append(version)
@@ -600,6 +2047,216 @@ def init_build_recipes():
         PACKAGES[package] = versions
     RECIPES_INITIALISED.append(1)
 
+# The version of a recipe with ``depends`` is a hash of the contents of the
+# files it depends on.
+def get_depends_version(recipe):
+    contents = {}
+    for pattern in recipe['depends']:
+        for file in glob(pattern):
+            dep_file = open(file, 'rb')
+            contents[file] = dep_file.read()
+            dep_file.close()
+    return sha1(''.join([
+        '%s\x00%s' % (f, contents[f])
+        for f in sorted(contents)
+        ])).hexdigest()
+
+# Check if any of the ``outputs`` of a recipe with ``depends`` are missing or
+# older than the files it depends on.
+def has_stale_outputs(recipe):
+    latest = 0
+    for pattern in recipe['depends']:
+        for file in glob(pattern):
+            dep_mtime = stat(file)[ST_MTIME]
+            if dep_mtime > latest:
+                latest = dep_mtime
+    for pattern in recipe['outputs']:
+        files = glob(pattern)
+        if not files:
+            return True
+        for file in files:
+            if not isfile(file):
+                return True
+            if stat(file)[ST_MTIME] <= latest:
+                return True
+    return False
+
+# Return the packages with ``depends`` whose outputs are stale. These are
+# treated as not being installed, so that they get rebuilt.
+def get_stale_packages():
+    stale = set()
+    for package in RECIPES:
+        for recipe in RECIPES[package].values():
+            if 'depends' in recipe and has_stale_outputs(recipe):
+                stale.add(package)
+    return stale
+
+# Remove the receipts of the packages with stale outputs. This is only done when
+# installing, whilst holding the exclusive ``LOCAL_LOCK``.
+def drop_stale_receipts():
+    stale = get_stale_packages()
+    for file in list_receipts():
+        for package in stale:
+            if file.startswith(package + '-'):
+                remove(join(RECEIPTS, file))
+    if stale:
+        reset_installed_packages()
+
+# ------------------------------------------------------------------------------
+# Manifest Cache
+# ------------------------------------------------------------------------------
+
+# Resolving recipes and roles means executing the recipe files and querying git
+# checkouts, which is slow. So we persist the resolved data in a manifest along
+# with a fingerprint of everything it was derived from. The fingerprint can be
+# checked with just a handful of stat calls, bar recipes with ``depends``, whose
+# versions are resolved exactly as when the recipes are initialised, so that
+# content changes are always noticed.
+
+def stat_files(paths):
+    stats = []
+    for path in paths:
+        try:
+            info = stat(path)
+        except OSError:
+            stats.append([path, None, None])
+        else:
+            stats.append([path, info.st_mtime, info.st_size])
+    return stats
+
+def read_file(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+# Resolve the commit of HEAD for the git checkout at the given ``path`` by
+# reading the git metadata directly. This returns None for any layout that we
+# don't understand, which just invalidates the manifest.
+def read_git_head(path):
+    git_dir = join(path, '.git')
+    try:
+        if isfile(git_dir):
+            gitdir = read_file(git_dir).strip()
+            if not gitdir.startswith('gitdir:'):
+                return None
+            git_dir = join(path, gitdir[7:].strip())
+        head = read_file(join(git_dir, 'HEAD')).strip()
+        if not head.startswith('ref:'):
+            return head
+        ref = head[4:].strip()
+        common_dir = git_dir
+        if isfile(join(git_dir, 'commondir')):
+            common_dir = join(git_dir, read_file(
+                join(git_dir, 'commondir')
+                ).strip())
+        for directory in [git_dir, common_dir]:
+            if isfile(join(directory, ref)):
+                return read_file(join(directory, ref)).strip()
+        packed_refs = join(common_dir, 'packed-refs')
+        if isfile(packed_refs):
+            for line in read_file(packed_refs).splitlines():
+                if line.endswith(' ' + ref):
+                    return line.split()[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+def get_manifest_inputs():
+    files = [CONF_PATH] + BUILD_RECIPES
+    for path in ROLES_PATH:
+        files.append(path)
+        files.extend(sorted(
+            join(path, f) for f in listdir(path) if f.endswith('.yaml')
+            ))
+    return {
+        'files': stat_files(files),
+        'recipes_path': BUILD_RECIPES,
+        'roles_path': ROLES_PATH
+        }
+
+# Return the git checkouts and the recipes with ``depends`` amongst the resolved
+# recipes, along with their versions.
+def get_recipe_dependencies():
+    git = {}
+    depends = []
+    for package in sorted(RECIPES):
+        for version, recipe in sorted(RECIPES[package].iteritems()):
+            if recipe.get('type') == 'git':
+                git[join(ENVIRON, recipe['path'])] = version
+            elif 'depends' in recipe:
+                depends.append([package, {
+                    'depends': recipe['depends'],
+                    'outputs': recipe['outputs']
+                    }, version])
+    return git, depends
+
+def is_fresh(inputs, git, depends):
+    if inputs != get_manifest_inputs():
+        return False
+    for path, head in git.iteritems():
+        if read_git_head(path) != head:
+            return False
+    for package, recipe, version in depends:
+        if get_depends_version(recipe) != version:
+            return False
+    return True
+
+def load_manifest():
+    if not isfile(MANIFEST):
+        return None
+    try:
+        manifest = decode_json(read_file(MANIFEST))
+    except Exception:
+        return None
+    if not is_fresh(manifest.get('inputs'), manifest['git'],
+                    manifest['depends']):
+        return None
+    return manifest
+
+def get_manifest():
+    manifest = load_manifest()
+    if manifest is None:
+        manifest = create_manifest()
+    return manifest
+
+# Return the names of the packages with build recipes. The manifest is used if
+# it's up-to-date, so that tab completion doesn't need to execute the recipes.
+def get_recipe_names():
+    manifest = load_manifest()
+    if manifest:
+        return manifest['recipes'].keys()
+    init_build_recipes()
+    return RECIPES.keys()
+
+# Resolve all of the recipes and roles and persist the resulting manifest.
+def create_manifest():
+    inputs = get_manifest_inputs()
+    roles = get_role_names()
+    role_packages = {}
+    for role in roles:
+        role_packages[role] = sorted(load_role(role))
+    git, depends = get_recipe_dependencies()
+    build_info = render_build_info(roles)
+    manifest = {
+        'build_info': build_info,
+        'build_info_hash': sha256(build_info).hexdigest(),
+        'depends': depends,
+        'git': git,
+        'inputs': inputs,
+        'packages': dict(TO_INSTALL),
+        'recipes': PACKAGES,
+        'roles': role_packages
+        }
+    mkdir(STATE)
+    tmp_path = '%s.%d' % (MANIFEST, os.getpid())
+    manifest_file = open(tmp_path, 'wb')
+    manifest_file.write(encode_json(manifest, sort_keys=True))
+    manifest_file.close()
+    os.rename(tmp_path, MANIFEST)
+    return manifest
+
 # ------------------------------------------------------------------------------
 # Build Types
 # ------------------------------------------------------------------------------
@@ -608,15 +2265,23 @@ BASE_BUILD = {
     'after': None,
     'before': None,
     'commands': None,
+    'cpu': 1,
     'distfile': "%(name)s-%(version)s.tar.bz2",
-    'distfile_url_base': DISTFILES_URL_BASE,
+    'distfile_url_base': None,
     'env': None,
+    'memory': None,
+    'timeout': None,
     }
 
 def default_build_commands(package, info):
     commands = []; add = commands.append
     if info['config_command']:
-        add([info['config_command']] + info['config_flags'])
+        command = [info['config_command']]
+        # Autoconf's cache lives within the build tree, so enabling it speeds up
+        # reconfiguring kept build trees with different flags.
+        if info['config_cache']:
+            command.append('--config-cache')
+        add(command + info['config_flags'])
     if info['separate_make_install']:
         add([MAKE])
     add([MAKE] + info['make_flags'])
@@ -625,34 +2290,198 @@ def default_build_commands(package, info):
 DEFAULT_BUILD = BASE_BUILD.copy()
 DEFAULT_BUILD.update({
     'commands': default_build_commands,
+    'config_cache': False,
     'config_command': './configure',
     'config_flags': ['--prefix=%s' % LOCAL],
     'make_flags': ['install'],
     'separate_make_install': False
     })
 
-PYTHON_BUILD = BASE_BUILD.copy()
-PYTHON_BUILD.update({
-    'commands': [
-        [sys.executable, 'setup.py', 'build_ext', '-i']
+# Compiled extensions are cached by the hash of the distfile they were built
+# from, along with the ABI and platform of the interpreter, the environment they
+# were built with and the installed versions of the packages they depend on, so
+# that reinstalling an unchanged Python package only needs to copy them back
+# into place.
+PYTHON_EXTENSIONS = join(BUILD_WORKING_DIRECTORY, 'extensions')
+
+def get_python_build_key(package, info):
+    from distutils import sysconfig, util
+    abi = sysconfig.get_config_var('SOABI')
+    if not abi:
+        abi = 'cpython-%d%d' % sys.version_info[:2]
+        if sys.maxunicode > 0xffff:
+            abi += 'u'
+    env = {'CPPFLAGS': CPPFLAGS, 'LDFLAGS': LDFLAGS}
+    for key in list(env):
+        if key in environ:
+            env[key] = environ[key]
+    if info['env']:
+        env.update(info['env'])
+    installed = get_installed_packages()
+    requires = [
+        [dep, installed.get(dep)] for dep in sorted(get_dependencies(package))
         ]
-    })
-
-def resource_build_commands(package, info):
-    source = info['source'] or join(BUILD_WORKING_DIRECTORY, package)
-    destination = info['destination'] or join(SHARE, package)
-    return [['cp', '-R', source, destination]]
+    return sha256(encode_json([
+        info['hash'], abi, util.get_platform(), normalise_recipe_value(env),
+        requires
+        ], sort_keys=True)).hexdigest()
+
+def get_extension_suffixes():
+    import imp
+    return tuple(
+        suffix for suffix, mode, type in imp.get_suffixes()
+        if type == imp.C_EXTENSION
+        )
 
+def restore_python_extensions(package, key):
+    source = join(PYTHON_EXTENSIONS, key)
+    emit('cache_hit', kind='extensions', package=package)
+    log("Reusing the cached extensions for %s" % package, PROGRESS)
+    for dirpath, dirnames, filenames in os.walk(source):
+        for filename in filenames:
+            path = join(dirpath, filename)
+            dest = path[len(source) + 1:]
+            if dirname(dest):
+                mkdir(dirname(dest))
+            copy(path, dest)
+
+def cache_python_extensions(key):
+    suffixes = get_extension_suffixes()
+    tmp_path = join(PYTHON_EXTENSIONS, '.%s.%d' % (key, os.getpid()))
+    for dirpath, dirnames, filenames in os.walk('.'):
+        if dirpath == '.' and 'build' in dirnames:
+            dirnames.remove('build')
+        for filename in filenames:
+            if not filename.endswith(suffixes):
+                continue
+            path = join(dirpath, filename)
+            dest = join(tmp_path, path[2:])
+            mkdir(dirname(dest))
+            copy(path, dest)
+    if not isdir(tmp_path):
+        return
+    try:
+        os.rename(tmp_path, join(PYTHON_EXTENSIONS, key))
+    except OSError:
+        # Another redpill process has already cached them.
+        rmdir(tmp_path)
+
+def python_build_commands(package, info):
+    key = None
+    if info.get('hash') and info['cache_extensions']:
+        key = get_python_build_key(package, info)
+        if isdir(join(PYTHON_EXTENSIONS, key)):
+            return [lambda: restore_python_extensions(package, key)]
+    # The distutils of Python 2 can't compile extensions in parallel itself,
+    # so setup.py is run via a wrapper which makes it.
+    command = [sys.executable, 'setup.py', 'build_ext', '-i']
+    if NUMBER_OF_CPUS > 1:
+        command[1:1] = [
+            '-m', 'redpill.buildext', '--jobs=%d' % NUMBER_OF_CPUS
+            ]
+    if key:
+        return [command, lambda: cache_python_extensions(key)]
+    return [command]
+
+PYTHON_BUILD = BASE_BUILD.copy()
+PYTHON_BUILD.update({
+    'cache_extensions': True,
+    'commands': python_build_commands
+    })
+
+# Make ``destination`` mirror ``source``, only copying the files which have
+# changed and removing those of the ``owned`` paths, i.e. those from the receipt
+# of the previous install, which no longer exist. Files of the same size but
+# with a different mtime are compared by content, as unpacking a new distfile
+# usually touches everything.
+def sync_directory(source, destination, owned):
+    import filecmp
+    from shutil import copy2
+    expected = set()
+    copied = removed = 0
+    for dirpath, dirnames, filenames in os.walk(source):
+        relative = dirpath[len(source) + 1:]
+        for name in dirnames + filenames:
+            path = join(dirpath, name)
+            dest = join(destination, relative, name)
+            expected.add(dest)
+            if islink(path):
+                target = os.readlink(path)
+                if islink(dest) and os.readlink(dest) == target:
+                    continue
+                if isdir(dest) and not islink(dest):
+                    rmtree(dest)
+                elif islink(dest) or exists(dest):
+                    remove(dest)
+                os.symlink(target, dest)
+                copied += 1
+            elif isdir(path):
+                if islink(dest) or (exists(dest) and not isdir(dest)):
+                    remove(dest)
+                mkdir(dest)
+            else:
+                if islink(dest):
+                    remove(dest)
+                elif isdir(dest):
+                    rmtree(dest)
+                elif isfile(dest):
+                    info, dest_info = stat(path), stat(dest)
+                    if info.st_size == dest_info.st_size:
+                        if int(info.st_mtime) == int(dest_info.st_mtime):
+                            continue
+                        if filecmp.cmp(path, dest, False):
+                            os.utime(dest, (info.st_atime, info.st_mtime))
+                            continue
+                    # The file is replaced instead of being written over, as
+                    # it may be hardlinked into another generation.
+                    remove(dest)
+                copy2(path, dest)
+                copied += 1
+    for dirpath, dirnames, filenames in os.walk(destination, topdown=False):
+        for name in dirnames + filenames:
+            path = join(dirpath, name)
+            if path in expected or path not in owned:
+                continue
+            if isdir(path) and not islink(path):
+                if listdir(path):
+                    continue
+                os.rmdir(path)
+            else:
+                remove(path)
+            removed += 1
+    log("Synced %s: copied %d and removed %d files" % (
+        destination, copied, removed
+        ), PROGRESS)
+
+def resource_build_commands(package, info):
+    source = get_resource_source(package, info)
+    destination = get_resource_destination(package, info)
+    if info['sync']:
+        owned = KEPT_FILES.get(package, set())
+        return [lambda: sync_directory(source, destination, owned)]
+    return [['cp', '-R', source, destination]]
+
+def get_resource_source(package, info):
+    return info['source'] or join(BUILD_WORKING_DIRECTORY, package)
+
+def get_resource_destination(package, info):
+    return info['destination'] or join(SHARE, package)
+
+# Resources can opt into being synced, which makes ``destination`` mirror the
+# ``source`` instead of copying it within any existing ``destination``. The
+# files from the previous install are kept in place when they're upgraded, so
+# that only the changes need to be copied.
 RESOURCE_BUILD = BASE_BUILD.copy()
 RESOURCE_BUILD.update({
     'commands': resource_build_commands,
-    'source': None,
     'destination': None,
+    'source': None,
+    'sync': False
     })
 
 def jar_install(package, info):
     filename = info['distfile'] % {'name': package, 'version': info['version']}
-    return [lambda: copy(filename, join(BIN, filename))]
+    return [lambda: copy(join(DISTFILES, filename), join(BIN, filename))]
 
 JAR_BUILD = BASE_BUILD.copy()
 JAR_BUILD.update({
@@ -660,9 +2489,21 @@ JAR_BUILD.update({
     'commands': jar_install
     })
 
+# Incremental git builds reuse the objects left in the checkout by the previous
+# build, unless any of the files matching ``build_files`` have changed.
+GIT_BUILD_FILES = [
+    '*.am', '*.cmake', '*.in', '*.mk', 'CMakeLists.txt', 'GNUmakefile',
+    'Makefile', 'Makefile.*', 'SConscript', 'SConstruct', 'configure',
+    'configure.*', 'makefile', 'meson.build', 'setup.cfg', 'setup.py',
+    'wscript'
+    ]
+
 GIT_BUILD = BASE_BUILD.copy()
 GIT_BUILD.update({
-    'distfile': ''
+    'build_files': GIT_BUILD_FILES,
+    'clean': False,
+    'distfile': '',
+    'incremental': False
     })
 
 MAKELIKE_BUILD = BASE_BUILD.copy()
@@ -684,30 +2525,128 @@ BUILD_TYPES = {
 # ------------------------------------------------------------------------------
 
 TO_INSTALL = {}
+TO_REBUILD = set()
 TO_UNINSTALL = {}
 
+# The paths which were kept in place when uninstalling each syncing resource
+# package, so that only these are removed when it's synced again.
+KEPT_FILES = {}
+
+# Return the names of the receipt files, ignoring any temporary files from
+# receipts which are in the middle of being written.
+def list_receipts():
+    if not isdir(RECEIPTS):
+        return []
+    return [f for f in listdir(RECEIPTS) if not f.startswith('.')]
+
 def get_installed_packages(called=[], cache={}):
     if called:
         return cache
     called.append(1)
-    cache.update(dict(f.split('-', 1) for f in listdir(RECEIPTS)))
+    cache.update(dict(f.split('-', 1) for f in list_receipts()))
     return cache
 
+def reset_installed_packages():
+    called, cache = get_installed_packages.func_defaults
+    del called[:]
+    cache.clear()
+
+# Return the size and sha256 digest of the file at ``path``, or None if it
+# doesn't exist. Symlinks are recorded by the digest of their target.
+def get_file_record(path):
+    try:
+        if islink(path):
+            return 'link', sha256(os.readlink(path)).hexdigest()
+        digest = sha256()
+        size = 0
+        record_file = open(path, 'rb')
+        for chunk in iter(lambda: record_file.read(1024 * 1024), ''):
+            digest.update(chunk)
+            size += len(chunk)
+        record_file.close()
+        return str(size), digest.hexdigest()
+    except (IOError, OSError):
+        return None
+
+# Receipts list a path relative to the local directory per line. Directories
+# have a trailing slash, whilst files are followed by their size and sha256
+# digest, separated by tabs. Older receipts only have the paths, so the size
+# and digest are None for them.
+def read_receipt(receipt_path):
+    entries = []
+    receipt = open(receipt_path, 'rb')
+    for line in receipt:
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        fields = line.split('\t')
+        if len(fields) == 3:
+            entries.append((fields[0], fields[1], fields[2]))
+        else:
+            entries.append((line, None, None))
+    receipt.close()
+    return entries
+
+# Atomically write the receipt for the given package version so that other
+# redpill processes never see a partial receipt.
+def write_receipt(package, version, listing, records=None):
+    filename = '%s-%s' % (package, version)
+    tmp_path = join(RECEIPTS, '.%s.%d' % (filename, os.getpid()))
+    lines = []
+    for path in sorted(listing):
+        if records is not None and path in records:
+            record = records[path]
+        elif path.endswith('/'):
+            record = None
+        else:
+            record = get_file_record(join(LOCAL, path))
+        if record:
+            lines.append('%s\t%s\t%s' % (path, record[0], record[1]))
+        else:
+            lines.append(path)
+    receipt = open(tmp_path, 'wb')
+    receipt.write('\n'.join(lines))
+    receipt.close()
+    os.rename(tmp_path, join(RECEIPTS, filename))
+
+# Update the sizes and digests of the given ``paths`` within the receipts, e.g.
+# after files have been relocated.
+def update_receipt_records(paths):
+    paths = set(paths)
+    for filename in list_receipts():
+        entries = read_receipt(join(RECEIPTS, filename))
+        if not [entry for entry in entries if entry[0] in paths]:
+            continue
+        records = {}
+        for path, size, digest in entries:
+            if size and path not in paths:
+                records[path] = (size, digest)
+            elif not size and not path.endswith('/'):
+                records[path] = None
+        package, version = filename.split('-', 1)
+        write_receipt(
+            package, version, [entry[0] for entry in entries], records
+            )
+
 def get_installed_dependencies(
     package, gathered=None, raw_types=['git', 'makelike']
     ):
     if gathered is None:
         gathered = set()
-    else:
-        gathered.add(package)
-    installed_version = get_installed_packages()[package]
+    installed_version = get_installed_packages().get(package)
     recipes = RECIPES[package]
     if recipes.values()[0].get('type') in raw_types:
         recipe = recipes.values()[0]
-    else:
+    elif installed_version in recipes:
         recipe = recipes[installed_version]
+    else:
+        # The recipe for the installed version may have been replaced by a
+        # newer one, in which case we fall back to the latest recipe.
+        recipe = recipes[PACKAGES[package][0]]
     for dep in recipe.get('requires', []):
-        get_installed_dependencies(dep, gathered)
+        if dep not in gathered and dep in RECIPES:
+            gathered.add(dep)
+            get_installed_dependencies(dep, gathered)
     return gathered
 
 def get_installed_data():
@@ -722,20 +2661,230 @@ def get_installed_data():
     return installed, inverse_dependencies
 
 # Check and load the build recipe for the given package name and add it to the
-# ``TO_INSTALL`` set.
-def install_package(package):
+# ``targets``, which default to the ``TO_INSTALL`` set.
+def install_package(package, targets=TO_INSTALL):
     if package not in RECIPES:
         exit(
             "ERROR: Couldn't find a build recipe for the %s package."
             % package
             )
     version = PACKAGES[package][0]
-    TO_INSTALL[package] = version
+    targets[package] = version
     for dependency in RECIPES[package][version].get('requires', []):
-        install_package(dependency)
+        install_package(dependency, targets)
+
+# Return the given ``packages`` ordered so that each one comes after any of the
+# other ``packages`` that it depends on. Amongst the packages which are ready to
+# be built, those with the highest ``priorities`` are picked first.
+def sort_by_dependencies(packages, priorities=None):
+    if priorities is None:
+        priorities = {}
+    key = lambda package: (-priorities.get(package, 0), package)
+    packages = set(packages)
+    pending = {}
+    dependents = {}
+    for package in packages:
+        deps = get_dependencies(package).intersection(packages)
+        deps.discard(package)
+        pending[package] = len(deps)
+        for dep in deps:
+            dependents.setdefault(dep, []).append(package)
+    ready = sorted(
+        [package for package in packages if not pending[package]], key=key
+        )
+    ordered = []
+    while ready:
+        package = ready.pop(0)
+        ordered.append(package)
+        for dependent in dependents.get(package, []):
+            pending[dependent] -= 1
+            if not pending[dependent]:
+                ready.append(dependent)
+        ready.sort(key=key)
+    if len(ordered) != len(packages):
+        exit(
+            "ERROR: Found a dependency cycle between: %s"
+            % ', '.join(sorted(packages.difference(ordered)))
+            )
+    return ordered
+
+# Compute the minimal set of installed packages that need to be rebuilt, i.e.
+# those whose installed version differs from the one in ``targets`` along with
+# every installed package which depends on them. The packages in ``TO_REBUILD``
+# are reinstalled as they are, e.g. to repair them, so nothing else is rebuilt
+# because of them.
+def get_rebuild_set(targets, installed, inverse_dependencies):
+    changed = set()
+    for package in targets:
+        if package in installed and targets[package] != installed[package]:
+            changed.add(package)
+    rebuild = set(changed)
+    for package in changed:
+        rebuild.update(inverse_dependencies.get(package, []))
+    rebuild.update(package for package in TO_REBUILD if package in installed)
+    return rebuild
+
+# Work out the changes needed to bring the install in line with ``TO_INSTALL``
+# without touching anything on disk or ``TO_INSTALL`` itself. Returns the set of
+# installed packages to uninstall, the list of packages to install in dependency
+# order and the versions of all the packages which are to be installed.
+def plan_install():
+    # We assume the invariant that all packages only have one version installed.
+    installed, inverse_dependencies = get_installed_data()
+    stale = get_stale_packages()
+    if stale:
+        installed = dict(
+            (package, version) for package, version in installed.iteritems()
+            if package not in stale
+            )
+    versions = dict(TO_INSTALL)
+    # Reverse dependencies which aren't part of the current install set still
+    # need to be rebuilt against the new versions of their dependencies, which
+    # may in turn pull in further changes.
+    while 1:
+        uninstall = get_rebuild_set(versions, installed, inverse_dependencies)
+        missing = [
+            package for package in uninstall
+            if package not in versions and package in RECIPES
+            ]
+        if not missing:
+            break
+        for package in missing:
+            install_package(package, versions)
+    to_install = set(
+        package for package in versions
+        if package in uninstall or package not in installed
+        )
+    history = load_build_history()
+    estimates = dict(
+        (package, estimate_build_time(package, versions[package], history))
+        for package in to_install
+        )
+    priorities = get_chain_costs(to_install, estimates)
+    return uninstall, sort_by_dependencies(to_install, priorities), versions
+
+# Return the plan along with the recipe hashes of the builds which can be
+# shared with other environs.
+def get_plan_data(uninstall, to_install, versions):
+    hashes = {}
+    return {
+        'install': [[package, versions[package]] for package in to_install],
+        'recipe_hashes': dict(
+            (package, get_recipe_hash(package, hashes))
+            for package in to_install
+            ),
+        'uninstall': sorted(uninstall)
+        }
+
+def emit_plan(uninstall, to_install, versions):
+    if EVENTS:
+        emit('plan', **get_plan_data(uninstall, to_install, versions))
+
+def print_install_plan(uninstall, to_install, versions):
+    if not (uninstall or to_install):
+        log("All packages are up-to-date.", SUCCESS)
+        return
+    installed = get_installed_packages()
+    for package in sorted(uninstall):
+        if package not in versions:
+            log("Would uninstall %s %s" % (package, installed[package]))
+    for package in to_install:
+        version = versions[package]
+        if package not in uninstall:
+            log("Would install %s %s" % (package, version))
+        elif installed[package] != version:
+            log("Would rebuild %s %s (replacing %s)" % (
+                package, version, installed[package]
+                ))
+        elif package in TO_REBUILD:
+            log("Would reinstall %s %s" % (package, version))
+        else:
+            log("Would rebuild %s %s (dependency changed)" % (package, version))
+
+# Decide whether the checkout for an incremental git build needs to be cleaned,
+# based on the files which have changed since the ``previous`` commit that was
+# installed. We fall back to a clean build if the build system has changed or if
+# the changes can't be determined, e.g. because of a rewritten history. As the
+# object files from the previous build would be stale against new headers, we
+# also do a clean build if any of its dependencies are at a different version
+# to the ones it was last built against -- which is always the case when the
+# package is rebuilt at the same commit.
+def get_dependency_versions(package):
+    installed = get_installed_packages()
+    return dict(
+        (dep, installed.get(dep)) for dep in get_dependencies(package)
+        )
+
+def needs_clean_build(package, info, previous, version):
+    if not previous:
+        return info['clean']
+    if previous == version:
+        log("Doing a clean build of %s as its dependencies have changed"
+            % package, PROGRESS)
+        return True
+    record = load_build_history().get(package, {}).get(previous, {})
+    if record.get('requires') != get_dependency_versions(package):
+        log("Doing a clean build of %s as it was built against other versions"
+            " of its dependencies" % package, PROGRESS)
+        return True
+    output, retcode = run_command(
+        ['git', 'diff', '--name-only', previous, version], retcode=True
+        )
+    if retcode:
+        log("Doing a clean build of %s as the changes since %s are unknown"
+            % (package, previous[:8]), PROGRESS)
+        return True
+    changed = output.splitlines()
+    for path in changed:
+        for pattern in info['build_files']:
+            if fnmatch(path, pattern) or fnmatch(basename(path), pattern):
+                log("Doing a clean build of %s as %s has changed"
+                    % (package, path), PROGRESS)
+                return True
+    log("Incrementally building %s with %d changed files since %s"
+        % (package, len(changed), previous[:8]), PROGRESS)
+    return False
+
+# Classify a build command for the timing reports.
+def get_command_category(command):
+    name = command[0].rsplit('/', 1)[-1]
+    if 'configure' in name:
+        return 'configure'
+    if name in ('make', 'gmake', MAKE):
+        return 'make'
+    return 'command'
 
 # Handle the actual installation/uninstallation of appropriate packages.
-def install_packages(types=BUILD_TYPES):
+def install_packages(
+    types=BUILD_TYPES, dry_run=False, trace=None, capture=False
+    ):
+
+    if dry_run:
+        uninstall, to_install, versions = plan_install()
+        emit_plan(uninstall, to_install, versions)
+        print_install_plan(uninstall, to_install, versions)
+        return
+
+    start = time()
+    status = 'failed'
+    try:
+        if use_generations():
+            install_generation(types, capture)
+        else:
+            _install_packages(types, capture)
+        status = 'success'
+        cap = get_working_directory_cap()
+        if cap is not None:
+            reclaimed = collect_garbage(cap)
+            if reclaimed:
+                log("Reclaimed %s from the working directory" % (
+                    format_size(reclaimed)
+                    ), SUCCESS)
+    finally:
+        if TIMINGS or status == 'failed':
+            write_timing_report(start, status, trace)
+
+def _install_packages(types, capture):
 
     for path in PRE_INSTALLS:
         if isfile(path):
@@ -743,6 +2892,7 @@ def install_packages(types=BUILD_TYPES):
 
     ensure = get_conf('ensure', None)
     if ensure:
+        pool = TaskPool()
         ns = globals()
         for runtime, version in ensure.items():
             func_name = 'ensure_%s_version' % runtime
@@ -759,98 +2909,119 @@ def install_packages(types=BUILD_TYPES):
                 extra = None
             version = tuple(map(int, version.split('.')))
             if extra:
-                ensure(version, extra)
+                args = (version, extra)
             else:
-                ensure(version)
+                args = (version,)
+            pool.spawn(traced_call, 'ensure', runtime, ensure, *args)
+        pool.wait()
 
     for directory in [
-        BUILD_WORKING_DIRECTORY, LOCAL, BIN, SHARE, TMP
+        BUILD_WORKING_DIRECTORY, DISTFILES, LOCAL, BIN, SHARE, TMP
         ]:
         mkdir(directory)
 
-    cleanup_install()
-
-    # We assume the invariant that all packages only have one version installed.
-    installed, inverse_dependencies = get_installed_data()
-    uninstall = set()
-
-    for package in TO_INSTALL:
-        if package in installed:
-            existing_version = installed[package]
-            if TO_INSTALL[package] != existing_version:
-                uninstall.add(package)
-                for inv_dep in inverse_dependencies.get(package, []):
-                    uninstall.add(package)
-
+    # Anything which modifies the local directory is done whilst holding the
+    # exclusive ``INSTALL_LOCK``, as receipts are generated by comparing
+    # listings of it. The exclusive ``LOCAL_LOCK`` is only held whilst changes
+    # are committed, i.e. receipts written and files removed, so that readers,
+    # which take it shared, aren't held up by downloads and compiles. Packages
+    # are also locked individually, so that concurrent redpill processes don't
+    # build or uninstall the same package at the same time. As builds install
+    # straight into the local directory, the ``INSTALL_LOCK`` is held from the
+    # ``before`` hook through to the receipt, and so the builds of disjoint
+    # packages by concurrent processes are still serialised -- only their
+    # downloads and unpacking overlap.
+    with locked(INSTALL_LOCK), locked(LOCAL_LOCK):
+        with traced('cleanup'):
+            drop_stale_receipts()
+            cleanup_install()
+
+    # Remember the versions which were installed before any are uninstalled, so
+    # that incremental builds know what's changed since the last build.
+    previous = dict(get_installed_packages())
+
+    with locked(LOCAL_LOCK, shared=True):
+        uninstall, to_install_list, versions = plan_install()
+    emit_plan(uninstall, to_install_list, versions)
     if uninstall:
-        for package in uninstall:
-            uninstall_package(package)
-        uninstall_packages()
+        uninstall_locks = [get_package_lock(package) for package in uninstall]
+        for path in sorted(uninstall_locks):
+            lock(path)
+        with locked(INSTALL_LOCK), locked(LOCAL_LOCK):
+            for package in uninstall:
+                uninstall_package(package)
+            uninstall_packages(
+                get_sync_destinations(uninstall, versions, types)
+                )
+        for path in uninstall_locks:
+            unlock(path)
 
-    to_install = set(TO_INSTALL) - set(installed)
-
-    inverse_dependencies = {}
-    for package in to_install:
-        for dep in get_dependencies(package):
-            if dep in to_install:
-                if dep not in inverse_dependencies:
-                    inverse_dependencies[dep] = set()
-                inverse_dependencies[dep].add(package)
-
-    to_install_list = []
-    for package in to_install:
-        index = len(to_install_list)
-        for dep in inverse_dependencies.get(package, []):
-            try:
-                dep_index = to_install_list.index(dep)
-            except:
-                continue
-            else:
-                if dep_index < index:
-                    index = dep_index
-        to_install_list.insert(index, package)
-
-    current_filelisting = get_listing()
     install_data = []
-    install_items = len(to_install_list) - 1
+    tree_cap = get_build_tree_cap()
 
     for idx, package in enumerate(to_install_list):
 
-        version = TO_INSTALL[package]
+        version = versions[package]
         recipe = RECIPES[package][version]
         build_type = recipe.get('type', 'default')
         info = types[build_type].copy()
         info.update(recipe)
 
-        distfile = info['distfile'] % {'name': package, 'version': version}
-        if distfile:
-            url = info['distfile_url_base'] + distfile
-        else:
-            url = ''
-
+        distfile, url = get_distfile(package, version, info)
         install_data.append((idx, package, version, info, distfile, url))
 
-    if install_data:
-        _, _, _, info, distfile, url = install_data[0]
+    # Fire off all the downloads up front. They run concurrently, limited by the
+    # download pool, whilst the packages before them are being built.
+    downloads = {}
+    for idx, package, version, info, distfile, url in install_data:
         if distfile:
-            download_distfile(distfile, url, info['hash'])
+            downloads[package] = download_distfile(
+                distfile, url, info['hash'], fork=True, package=package,
+                hold=True
+                )
 
     for idx, package, version, info, distfile, url in install_data:
 
-        current_queue = DOWNLOAD_QUEUE[:]
-        if current_queue:
-            if idx:
-                log("Waiting for %s to download" % current_queue[0], PROGRESS)
-            while DOWNLOAD_QUEUE:
-                sleep(0.5)
+        if package in downloads:
+            download = downloads[package]
+            if idx and not download.done.isSet():
+                log("Waiting for %s to download" % distfile, PROGRESS)
+            try:
+                download.wait()
+            except TaskTimeout, err:
+                DOWNLOAD_ERROR.append(DownloadError(str(err)))
 
         if DOWNLOAD_ERROR:
+            DOWNLOAD_POOL.cancel()
             exit("ERROR: %s" % DOWNLOAD_ERROR[0].msg)
 
-        if idx < install_items:
-            _, _, _, infoN, distfileN, urlN = install_data[idx+1]
-            if distfileN:
-                download_distfile(distfileN, urlN, infoN['hash'], fork=True)
+        package_lock = get_package_lock(package)
+        lock(package_lock)
+        if isfile(join(RECEIPTS, '%s-%s' % (package, version))):
+            log("Skipping %s %s as another process has installed it" % (
+                package, version
+                ), PROGRESS)
+            unlock(package_lock)
+            if distfile:
+                release_distfile(distfile)
+            continue
+
+        # Builds which are identical to those of other environs being built in
+        # the same run are only done once.
+        artifact = artifact_lock = None
+        recipe_hash = ARTIFACTS and get_recipe_hash(package)
+        if recipe_hash:
+            artifact = join(ARTIFACTS, recipe_hash)
+            artifact_lock = artifact + '.lock'
+            lock(artifact_lock, wait=True)
+            if isdir(artifact) and install_shared_build(
+                package, version, artifact
+                ):
+                unlock(artifact_lock)
+                unlock(package_lock)
+                if distfile:
+                    release_distfile(distfile)
+                continue
 
         log("Installing %s %s" % (package, version))
 
@@ -860,18 +3031,41 @@ def install_packages(types=BUILD_TYPES):
                 log("Removing previously unpacked %s distfile" % package,
                     PROGRESS)
                 rmdir(package)
-            tar = tarfile.open(distfile, 'r:bz2')
-            log("Unpacking %s" % distfile, PROGRESS)
-            tar.extractall()
-            tar.close()
+            if not (tree_cap and restore_build_tree(package, info['hash'])):
+                log("Unpacking %s" % distfile, PROGRESS)
+                extract_start = time()
+                with timed(package, 'extract'):
+                    import tarfile
+                    tar = tarfile.open(join(DISTFILES, distfile), 'r:bz2')
+                    tar.extractall()
+                    tar.close()
+                emit(
+                    'extract', distfile=distfile,
+                    duration=time() - extract_start, package=package
+                    )
+            release_distfile(distfile)
             chdir(package)
         elif info.get('type') == 'git':
             chdir(join(ENVIRON, info['path']))
-            if info.get('clean'):
+            if info['incremental']:
+                clean = needs_clean_build(
+                    package, info, previous.get(package), version
+                    )
+            else:
+                clean = info['clean']
+            if clean:
                 do('git', 'clean', '-fdx')
 
+        # Builds are only admitted once we hold the install lock, so that a
+        # process which is waiting on it doesn't hold up other environs.
+        lock(INSTALL_LOCK, wait=True)
+        admit_build(package, info)
+        build_start = time()
+        current_filelisting = get_listing()
+
         if info['before']:
-            info['before']()
+            with traced('hook', 'before', package):
+                info['before']()
 
         env = environ.copy()
         if 'MAKE' in env:
@@ -897,125 +3091,1072 @@ def install_packages(types=BUILD_TYPES):
             exit("ERROR: Invalid build commands for %s %s: %r" %
                  (package, version, commands))
 
+        # In capture mode, the output of each command is streamed to a log
+        # file for the package instead of the terminal.
+        capture_file = None
+        if capture:
+            mkdir(BUILD_LOGS)
+            capture_path = join(BUILD_LOGS, '%s-%s.log' % (package, version))
+            capture_file = open(capture_path, 'wb')
+
         try:
             for command in commands:
                 if hasattr(command, '__call__'):
-                    command()
+                    name = getattr(command, '__name__', 'command')
+                    with command_events(package, name):
+                        with traced('command', name, package):
+                            command()
                 else:
                     log("Running: %s" % ' '.join(command), PROGRESS)
                     cmd_env = {'CPPFLAGS': CPPFLAGS, 'LDFLAGS': LDFLAGS}
                     cmd_env.update(env)
-                    kwargs = dict(env=cmd_env)
-                    do(*command, **kwargs)
-        except Exception:
-            error("ERROR: Building %s %s failed" % (package, version))
-            traceback.print_exc()
-            sys.exit(1)
-        except SystemExit:
-            cleanup_partial_install(current_filelisting)
+                    kwargs = dict(env=cmd_env, timeout=info['timeout'])
+                    if capture_file:
+                        capture_file.write('$ %s\n' % ' '.join(command))
+                        kwargs['capture'] = capture_file
+                        kwargs['progress'] = get_progress_display(
+                            '## %s: ' % package
+                            )
+                    with command_events(package, command), traced(
+                        get_command_category(command), ' '.join(command),
+                        package
+                        ):
+                        try:
+                            do(*command, **kwargs)
+                        finally:
+                            if capture_file:
+                                clear_progress_display()
+        except (Exception, SystemExit), err:
+            release_build(package)
+            emit('install_failed', package=package, version=version)
+            if isinstance(err, SystemExit):
+                cleanup_partial_install(current_filelisting)
+            else:
+                traceback.print_exc()
+            if capture_file:
+                error("ERROR: The full build log is at %s" % capture_path)
             exit("ERROR: Building %s %s failed" % (package, version))
+        finally:
+            if capture_file:
+                capture_file.close()
 
         if info['after']:
-            info['after']()
+            with traced('hook', 'after', package):
+                info['after']()
 
-        log("Successfully Installed %s %s" % (package, version), SUCCESS)
+        # Any other distfiles, e.g. jars, are used by the build commands, so
+        # they're only released once the build has finished.
+        if distfile:
+            release_distfile(distfile)
 
-        new_filelisting = get_listing()
-        receipt_data = new_filelisting.difference(current_filelisting)
-        current_filelisting = new_filelisting
+        record_timing(package, 'build', time() - build_start)
+        emit(
+            'install', duration=time() - build_start, package=package,
+            version=version
+            )
+        log("Successfully Installed %s %s" % (package, version), SUCCESS)
 
-        receipt = open(join(RECEIPTS, '%s-%s' % (package, version)), 'wb')
-        receipt.write('\n'.join(sorted(receipt_data)))
-        receipt.close()
+        with timed(package, 'receipt'), locked(LOCAL_LOCK):
+            receipt_data = get_listing().difference(current_filelisting)
+            if info.get('type') == 'resource' and info['sync']:
+                receipt_data = receipt_data.union(get_synced_listing(
+                    get_resource_source(package, info),
+                    get_resource_destination(package, info)
+                    ))
+            write_receipt(package, version, receipt_data)
+            get_installed_packages()[package] = version
+
+        if artifact and not isdir(artifact):
+            store_artifact(artifact, receipt_data)
+        unlock(INSTALL_LOCK)
+        release_build(package)
+        record_build_history(
+            package, version, get_dependency_versions(package)
+            )
 
         chdir(BUILD_WORKING_DIRECTORY)
         if distfile.endswith('.tar.bz2'):
-            rmdir(join(package))
+            if tree_cap:
+                keep_build_tree(package, info['hash'], tree_cap)
+            else:
+                rmdir(join(package))
+        if artifact_lock:
+            unlock(artifact_lock)
+        unlock(package_lock)
 
     chdir(CURRENT_DIRECTORY)
 
+# Return the destinations of the syncing resource packages amongst the given
+# ``packages`` which are about to be reinstalled.
+def get_sync_destinations(packages, versions, types):
+    destinations = {}
+    for package in packages:
+        if package not in versions:
+            continue
+        recipe = RECIPES[package][versions[package]]
+        if recipe.get('type') != 'resource':
+            continue
+        info = types['resource'].copy()
+        info.update(recipe)
+        if info['sync']:
+            destinations[package] = get_resource_destination(package, info)
+    return destinations
+
+# Return the listing of the files synced from ``source`` to a resource
+# ``destination``, as those which were kept from the previous install won't show
+# up as new.
+def get_synced_listing(source, destination):
+    if not destination.startswith(LOCAL + '/'):
+        return Listing()
+    prefix = destination[len(LOCAL) + 1:] + '/'
+    return Listing(
+        [prefix] + [prefix + path for path in Listing.scan(source)]
+        )
+
 # A utility function to uninstall a single package.
 def uninstall_package(package):
     installed = get_installed_packages()
     if package in installed:
         TO_UNINSTALL[package] = installed[package]
 
-# Handle the actual uninstallation of the various packages.
-def uninstall_packages():
+# Handle the actual uninstallation of the various packages. The files within
+# the directory given in ``keep`` for a package are left in place.
+def uninstall_packages(keep=None):
     installed = get_installed_packages()
     for name, version in TO_UNINSTALL.iteritems():
+        kept = keep and keep.get(name)
         log("Uninstalling %s %s" % (name, version))
+        start = time()
         installed_version = '%s-%s' % (name, version)
         receipt_path = join(RECEIPTS, installed_version)
-        receipt = open(receipt_path, 'rb')
+        if not isfile(receipt_path):
+            # Another redpill process has already uninstalled it.
+            installed.pop(name, None)
+            continue
         directories = set()
-        for path in receipt:
+        for path, size, digest in read_receipt(receipt_path):
             if isabs(path):
                 exit("ERROR: Got an absolute path in receipt %s" % receipt_path)
-            path = path.strip()
-            if not path:
-                continue
             path = join(LOCAL, path)
+            if kept and (path + '/').startswith(kept + '/'):
+                KEPT_FILES.setdefault(name, set()).add(path.rstrip('/'))
+                continue
             if not islink(path):
                 if not exists(path):
                     continue
             if isdir(path):
                 directories.add(path)
             else:
-                print "Removing:", path
+                log_removal(path)
                 remove(path)
         for path in reversed(sorted(directories)):
             if not listdir(path):
-                print "Removing Directory:", path
+                log_removal(path, True)
                 rmtree(path)
-        receipt.close()
         remove(receipt_path)
         del installed[name]
+        emit('uninstall', package=name, version=version)
+        record_span('uninstall', start, time(), package=name)
 
 def cleanup_install():
     current = get_listing()
-    expected = set()
-    for f in listdir(RECEIPTS):
-        f = open(join(RECEIPTS, f), 'rb')
-        expected.update(f.read().splitlines())
-        f.close()
+    expected = Listing()
+    for f in list_receipts():
+        for path, size, digest in read_receipt(join(RECEIPTS, f)):
+            expected.add(path)
     diff = current.difference(expected)
     for path in diff:
         if isabs(path):
             continue
         path = join(LOCAL, path)
         if not isdir(path):
-            print "Removing:", path
+            log_removal(path)
             remove(path)
 
 # ------------------------------------------------------------------------------
-# Main Runner
+# Verify Utilities
 # ------------------------------------------------------------------------------
 
-def main(argv=None, show_help=False):
+# Digests of verified files are cached by their stat info, so that files which
+# haven't changed since the last verify don't need to be read again.
+VERIFY_CACHE = join(STATE, 'verify-cache.json')
 
-    argv = argv or sys.argv[1:]
+# Files are only hashed across a pool of processes when there are enough of
+# them to make up for the cost of starting it.
+VERIFY_POOL_THRESHOLD = 32
 
-    # Set the script name to ``redpill`` so that OptionParser error messages
-    # don't display a potentially confusing ``redpill.py`` to end users.
-    sys.argv[0] = 'redpill'
+def get_stat_key(info):
+    return [info.st_size, info.st_mtime, info.st_ctime, info.st_ino]
+
+# Return the record for the file at ``path`` along with the ``path``, so that
+# it can be used with a process pool's ``imap_unordered``.
+def hash_file(path):
+    return path, get_file_record(path)
+
+def hash_files(paths, jobs):
+    if jobs < 2 or len(paths) < VERIFY_POOL_THRESHOLD:
+        return map(hash_file, paths)
+    from multiprocessing import Pool
+    pool = Pool(min(jobs, len(paths)))
+    try:
+        return list(pool.imap_unordered(hash_file, paths, 16))
+    finally:
+        pool.close()
+        pool.join()
+
+# Check the files owned by the given ``packages`` against their receipts and
+# return a mapping of each problem -- ``modified``, ``missing`` or
+# ``unverified`` -- to a list of (package, path) pairs.
+def verify_packages(packages, jobs):
+    cache = {}
+    if isfile(VERIFY_CACHE):
+        try:
+            cache = decode_json(read_file(VERIFY_CACHE))
+        except Exception:
+            pass
+    problems = {'missing': [], 'modified': [], 'unverified': []}
+    pending = {}
+    seen = {}
+    for package in sorted(packages):
+        receipt_path = join(RECEIPTS, '%s-%s' % (package, packages[package]))
+        for relpath, size, digest in read_receipt(receipt_path):
+            path = join(LOCAL, relpath)
+            try:
+                info = os.lstat(path)
+            except OSError:
+                problems['missing'].append((package, relpath))
+                continue
+            if relpath.endswith('/') or not size:
+                if not relpath.endswith('/'):
+                    problems['unverified'].append((package, relpath))
+                continue
+            if size == 'link' or str(info.st_size) == size:
+                key = get_stat_key(info)
+                cached = cache.get(path)
+                if cached and cached[:4] == key:
+                    seen[path] = cached
+                    if cached[4] != digest:
+                        problems['modified'].append((package, relpath))
+                else:
+                    pending[path] = (package, relpath, digest, key)
+            else:
+                problems['modified'].append((package, relpath))
+    if pending:
+        log("Hashing %d files" % len(pending), PROGRESS)
+    for path, record in hash_files(sorted(pending), jobs):
+        package, relpath, digest, key = pending[path]
+        if not record or record[1] != digest:
+            problems['modified'].append((package, relpath))
+        if record:
+            seen[path] = key + [record[1]]
+    try:
+        mkdir(STATE)
+        tmp_path = '%s.%d' % (VERIFY_CACHE, os.getpid())
+        cache_file = open(tmp_path, 'wb')
+        cache_file.write(encode_json(seen))
+        cache_file.close()
+        os.rename(tmp_path, VERIFY_CACHE)
+    except Exception:
+        pass
+    return problems
+
+# Return the files within the local directory which aren't in any receipt.
+def find_unowned_files():
+    expected = Listing()
+    for filename in list_receipts():
+        for path, size, digest in read_receipt(join(RECEIPTS, filename)):
+            expected.add(path)
+    return [
+        path for path in get_listing().difference(expected)
+        if not path.endswith('/')
+        ]
+
+# ------------------------------------------------------------------------------
+# Relocatable Snapshots
+# ------------------------------------------------------------------------------
+
+SNAPSHOT_METADATA = 'redpill-snapshot.json'
+SNAPSHOT_ROOTS = ('local', 'receipts')
+
+def get_file_digest(path):
+    digest = sha256()
+    digest_file = open(path, 'rb')
+    for chunk in iter(lambda: digest_file.read(1024 * 1024), ''):
+        digest.update(chunk)
+    digest_file.close()
+    return digest.hexdigest()
+
+# Find the files within ``root`` which have the given ``prefix`` baked into
+# them, e.g. scripts, pkg-config files and binaries with rpaths, along with any
+# absolute symlinks which point within it.
+def find_relocations(root, prefix, paths=None):
+    from mmap import mmap, ACCESS_READ
+    relocations = {'binary': [], 'links': [], 'text': []}
+    if paths is None:
+        paths = walk_paths(root)
+    for relpath in paths:
+        path = join(root, relpath)
+        if islink(path):
+            if os.readlink(path).startswith(prefix):
+                relocations['links'].append(relpath)
+            continue
+        if not isfile(path) or not os.path.getsize(path):
+            continue
+        data_file = open(path, 'rb')
+        data = mmap(data_file.fileno(), 0, access=ACCESS_READ)
+        try:
+            if data.find(prefix) != -1:
+                if data.find('\0') != -1:
+                    relocations['binary'].append(relpath)
+                else:
+                    relocations['text'].append(relpath)
+        finally:
+            data.close()
+            data_file.close()
+    return relocations
+
+def walk_paths(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            yield join(dirpath, name)[len(root) + 1:]
+
+# Rewrite the ``old`` prefix to the ``new`` one within the given relocations.
+# Binaries can't change size, so the new prefix is padded with slashes, which
+# means that they can only be relocated to a prefix which isn't any longer.
+def relocate(root, old, new, relocations):
+    if len(new) > len(old) and relocations['binary']:
+        exit(
+            "ERROR: Can't relocate %d binaries from %s to the longer prefix %s"
+            % (len(relocations['binary']), old, new)
+            )
+    padded = new + '/' * (len(old) - len(new))
+    for kind, replacement in [('text', new), ('binary', padded)]:
+        for relpath in relocations[kind]:
+            path = join(root, relpath)
+            mode = stat(path).st_mode
+            os.chmod(path, mode | 0200)
+            data_file = open(path, 'rb')
+            data = data_file.read().replace(old, replacement)
+            data_file.close()
+            data_file = open(path, 'wb')
+            data_file.write(data)
+            data_file.close()
+            os.chmod(path, mode)
+    for relpath in relocations['links']:
+        path = join(root, relpath)
+        target = os.readlink(path)
+        remove(path)
+        os.symlink(new + target[len(old):], path)
+
+# Pack the local install and receipts into a snapshot within ``directory``,
+# which is named after the hash of its contents. The full digest is written to
+# a ``.sha256`` file alongside it, in the format used by ``sha256sum``.
+def create_snapshot(directory):
+    import tarfile
+    from StringIO import StringIO
+    metadata = encode_json({
+        'environ': ENVIRON,
+        'installed': get_installed_packages(),
+        'platform': PLATFORM,
+        'prefix': LOCAL,
+        'relocations': find_relocations(LOCAL, LOCAL),
+        'time': time(),
+        'version': __release__
+        }, indent=2, sort_keys=True)
+    tmp_path = join(directory, '.redpill-snapshot.%d' % os.getpid())
+    tar = tarfile.open(tmp_path, 'w:gz')
+    try:
+        info = tarfile.TarInfo(SNAPSHOT_METADATA)
+        info.size = len(metadata)
+        info.mtime = time()
+        tar.addfile(info, StringIO(metadata))
+        tar.add(os.path.realpath(LOCAL), 'local')
+        tar.add(os.path.realpath(RECEIPTS), 'receipts')
+        tar.close()
+    except Exception:
+        tar.close()
+        remove(tmp_path)
+        raise
+    digest = get_file_digest(tmp_path)
+    path = join(directory, 'redpill-snapshot-%s.tar.gz' % digest[:16])
+    digest_file = open(tmp_path + '.sha256', 'wb')
+    digest_file.write('%s  %s\n' % (digest, basename(path)))
+    digest_file.close()
+    os.rename(tmp_path + '.sha256', path + '.sha256')
+    os.rename(tmp_path, path)
+    return path
+
+# Check the snapshot at ``path`` against the full digest within its ``.sha256``
+# file.
+def verify_snapshot(path):
+    try:
+        expected = read_file(path + '.sha256').split()[0]
+    except (IOError, IndexError):
+        exit("ERROR: Couldn't read the digest of the snapshot from %s.sha256"
+             % path)
+    if get_file_digest(path) != expected:
+        exit("ERROR: The snapshot %s doesn't match its digest" % path)
+
+# Check that extracting the snapshot ``members`` can't write outside of the
+# environ. Paths must be relative and within the snapshot roots, links must
+# point within the snapshot, or its ``prefix`` for symlinks which get
+# relocated, and nothing may be written through a symlink.
+def check_snapshot_members(members, prefix):
+    symlinks = set()
+    for member in members:
+        name = member.name.rstrip('/')
+        parts = name.split('/')
+        invalid = (
+            isabs(name) or '..' in parts or parts[0] not in SNAPSHOT_ROOTS or
+            name in symlinks
+            )
+        for idx in range(1, len(parts)):
+            if '/'.join(parts[:idx]) in symlinks:
+                invalid = True
+        if member.issym():
+            target = member.linkname
+            if isabs(target):
+                if target != prefix and not target.startswith(prefix + '/'):
+                    invalid = True
+            else:
+                target = os.path.normpath(join(dirname(name), target))
+                if target.split('/')[0] not in SNAPSHOT_ROOTS:
+                    invalid = True
+            symlinks.add(name)
+        elif member.islnk():
+            target = member.linkname.split('/')
+            if isabs(member.linkname) or '..' in target or (
+                target[0] not in SNAPSHOT_ROOTS
+                ):
+                invalid = True
+        elif not (member.isfile() or member.isdir()):
+            invalid = True
+        if invalid:
+            exit("ERROR: Got an invalid path in the snapshot: %s" % member.name)
+
+# Restore the local install and receipts from the snapshot at ``path``,
+# relocating them if the snapshot was taken with a different prefix. If the
+# environ uses generations, the snapshot is extracted into a new generation,
+# which is then switched to.
+def extract_snapshot(path):
+    import tarfile
+    verify_snapshot(path)
+    tar = tarfile.open(path, 'r:gz')
+    try:
+        metadata = decode_json(tar.extractfile(SNAPSHOT_METADATA).read())
+        members = [
+            member for member in tar.getmembers()
+            if member.name != SNAPSHOT_METADATA
+            ]
+        check_snapshot_members(members, metadata['prefix'].encode('utf-8'))
+        if metadata['platform'] != PLATFORM:
+            exit("ERROR: The snapshot is for %s, not %s" % (
+                metadata['platform'], PLATFORM
+                ))
+        old = metadata['prefix']
+        relocations = metadata['relocations']
+        if old != LOCAL and len(LOCAL) > len(old) and relocations['binary']:
+            exit(
+                "ERROR: Can't relocate %d binaries from %s to the longer "
+                "prefix %s" % (len(relocations['binary']), old, LOCAL)
+                )
+        generation = None
+        if islink(LOCAL):
+            generation = max(list_generations()) + 1
+            root = get_generation_path(generation)
+            mkdir(root)
+        else:
+            root = ENVIRON
+            rmdir(LOCAL)
+            rmdir(RECEIPTS)
+        tar.extractall(root, members)
+    finally:
+        tar.close()
+    if old != LOCAL:
+        log("Relocating %s to %s" % (old, LOCAL), PROGRESS)
+        relocations = dict(
+            (kind, [relpath.encode('utf-8') for relpath in paths])
+            for kind, paths in relocations.iteritems()
+            )
+        relocate(join(root, 'local'), old.encode('utf-8'), LOCAL, relocations)
+        if generation:
+            set_prefix(join(root, 'local'), join(root, 'receipts'))
+        try:
+            update_receipt_records(
+                relpath for paths in relocations.values() for relpath in paths
+                )
+        finally:
+            if generation:
+                set_prefix(LOCAL_LINK, RECEIPTS_LINK)
+    if generation:
+        switch_generation(generation)
+        log("Switched to generation %d" % generation, SUCCESS)
+        gc_generations()
+    reset_installed_packages()
+    return metadata
+
+# ------------------------------------------------------------------------------
+# Generations
+# ------------------------------------------------------------------------------
+
+# With generations enabled, via the ``generations`` config value or the
+# ``$REDPILL_GENERATIONS`` environment variable, the local install and receipts
+# live within numbered directories under ``gens``, and ``local`` and
+# ``receipts`` are symlinks to them via the ``gens/current`` symlink. Builds
+# populate a new generation from the current one and build into it, whilst
+# everything else carries on using the current one. Files of the packages which
+# aren't being rebuilt are hardlinked and checked for in-place changes before
+# switching, whilst the rest are copied. Once the build has succeeded, the newly
+# built files are relocated from the path of the generation to the ``local``
+# path and the ``current`` symlink is switched over atomically. A failed build
+# just leaves the current generation in place.
+GENERATIONS = join(ENVIRON, 'gens')
+GENERATIONS_LOCK = BUILD_WORKING_DIRECTORY + '.gens.lock'
+CURRENT_GENERATION = join(GENERATIONS, 'current')
+LOCAL_LINK = LOCAL
+RECEIPTS_LINK = RECEIPTS
+
+def use_generations():
+    value = environ.get('REDPILL_GENERATIONS', get_conf('generations', None))
+    return str(value).lower() not in ('', '0', 'false', 'no', 'none', 'off')
+
+def list_generations():
+    if not isdir(GENERATIONS):
+        return []
+    return sorted(int(name) for name in listdir(GENERATIONS) if name.isdigit())
+
+def get_current_generation():
+    if not islink(CURRENT_GENERATION):
+        return None
+    return int(os.readlink(CURRENT_GENERATION))
+
+def get_generation_path(generation, name=None):
+    path = join(GENERATIONS, str(generation))
+    if name:
+        return join(path, name)
+    return path
+
+def switch_generation(generation):
+    tmp_path = '%s.%d' % (CURRENT_GENERATION, os.getpid())
+    os.symlink(str(generation), tmp_path)
+    os.rename(tmp_path, CURRENT_GENERATION)
+    reset_installed_packages()
+    emit('generation', generation=generation)
+
+# Move any existing local install and receipts into the first generation.
+def init_generations():
+    if islink(CURRENT_GENERATION):
+        return
+    mkdir(get_generation_path(1))
+    for name, path in [('local', LOCAL_LINK), ('receipts', RECEIPTS_LINK)]:
+        if isdir(path):
+            os.rename(path, get_generation_path(1, name))
+        else:
+            mkdir(get_generation_path(1, name))
+        os.symlink(join('gens', 'current', name), path)
+    switch_generation(1)
+
+# Return the size and digest recorded for each file owned by the installed
+# packages other than the given ``packages``.
+def get_kept_records(packages):
+    records = {}
+    for package, version in get_installed_packages().iteritems():
+        if package in packages:
+            continue
+        receipt_path = join(RECEIPTS, '%s-%s' % (package, version))
+        for path, size, digest in read_receipt(receipt_path):
+            if not path.endswith('/'):
+                records[path] = (size, digest)
+    return records
+
+# Populate ``destination`` with the files within ``source``. Only the files in
+# ``records``, i.e. those of the packages which aren't being rebuilt, are
+# hardlinked, whilst everything else is copied. Returns the size and mtime of
+# each of the hardlinked files, so that they can be checked for changes later.
+def link_tree(source, destination, records):
+    from shutil import copy2
+    linked = {}
+    for dirpath, dirnames, filenames in os.walk(source):
+        relative = dirpath[len(source) + 1:]
+        target = join(destination, relative)
+        mkdir(target)
+        os.chmod(target, stat(dirpath).st_mode & 07777)
+        for name in dirnames + filenames:
+            path = join(dirpath, name)
+            if islink(path):
+                os.symlink(os.readlink(path), join(target, name))
+            elif isfile(path):
+                relpath = join(relative, name)
+                if relpath in records:
+                    os.link(path, join(target, name))
+                    info = os.lstat(path)
+                    linked[relpath] = (info.st_size, info.st_mtime)
+                else:
+                    copy2(path, join(target, name))
+    return linked
+
+# Return the hardlinked files within ``root`` which have been modified in place
+# since they were ``linked``, by checking any whose size or mtime has changed
+# against the ``records`` from their receipts.
+def find_modified_links(root, linked, records):
+    modified = []
+    for relpath in sorted(linked):
+        path = join(root, relpath)
+        try:
+            info = os.lstat(path)
+        except OSError:
+            modified.append(relpath)
+            continue
+        if (info.st_size, info.st_mtime) == linked[relpath]:
+            continue
+        size, digest = records[relpath]
+        if not size or get_file_record(path) != (size, digest):
+            modified.append(relpath)
+    return modified
+
+# Point the prefix that packages are installed into, along with everything
+# derived from it, at the given paths. The recipes are executed again when
+# next needed, so that any paths within them match too.
+def set_prefix(local, receipts):
+    global BIN, CPPFLAGS, INCLUDE, INFO, LDFLAGS, LIB, LOCAL, MAN, RECEIPTS
+    global SHARE, TMP, VAR
+    LOCAL = local
+    SHARE = join(LOCAL, 'share')
+    BIN = join(LOCAL, 'bin')
+    INCLUDE = join(LOCAL, 'include')
+    INFO = join(SHARE, 'info')
+    LIB = join(LOCAL, 'lib')
+    MAN = join(SHARE, 'man')
+    RECEIPTS = receipts
+    TMP = join(LOCAL, 'tmp')
+    VAR = join(LOCAL, 'var')
+    CPPFLAGS = "-I%s" % INCLUDE
+    LDFLAGS = "-L%s" % LIB
+    DEFAULT_BUILD['config_flags'] = ['--prefix=%s' % LOCAL]
+    RECIPES.clear()
+    PACKAGES.clear()
+    del RECIPES_INITIALISED[:]
+    reset_installed_packages()
+
+# Relocate the files from the given ``receipts`` which refer to the path of the
+# generation being built to the ``local`` path.
+def relocate_generation(receipts):
+    paths = set()
+    for filename in receipts:
+        for path, size, digest in read_receipt(join(RECEIPTS, filename)):
+            if not path.endswith('/') or islink(join(LOCAL, path[:-1])):
+                paths.add(path.rstrip('/'))
+    relocations = find_relocations(LOCAL, LOCAL, sorted(paths))
+    relocated = [path for kind in relocations.values() for path in kind]
+    if not relocated:
+        return
+    log("Relocating %d files to %s" % (len(relocated), LOCAL_LINK), PROGRESS)
+    relocate(LOCAL, LOCAL, LOCAL_LINK, relocations)
+    update_receipt_records(relocated)
+
+def get_receipt_inodes():
+    return dict(
+        (f, stat(join(RECEIPTS, f)).st_ino) for f in list_receipts()
+        )
+
+def install_generation(types, capture):
+    with locked(GENERATIONS_LOCK):
+        init_generations()
+        uninstall, to_install, versions = plan_install()
+        if not (uninstall or to_install):
+            _install_packages(types, capture)
+            return
+        current = get_current_generation()
+        generation = max(list_generations()) + 1
+        log("Populating generation %d from generation %d" % (
+            generation, current
+            ), PROGRESS)
+        # The files of the packages being rebuilt are copied, so that builds
+        # which write to existing files in place can't modify the current
+        # generation through them.
+        records = get_kept_records(uninstall.union(to_install))
+        linked = link_tree(
+            get_generation_path(current, 'local'),
+            get_generation_path(generation, 'local'), records
+            )
+        copytree(
+            get_generation_path(current, 'receipts'),
+            get_generation_path(generation, 'receipts')
+            )
+        set_prefix(
+            get_generation_path(generation, 'local'),
+            get_generation_path(generation, 'receipts')
+            )
+        # Receipts are replaced when written, so the ones for the packages
+        # which get built can be told apart by their inodes.
+        existing = get_receipt_inodes()
+        try:
+            init_build_recipes()
+            _install_packages(types, capture)
+            relocate_generation([
+                f for f, inode in get_receipt_inodes().iteritems()
+                if existing.get(f) != inode
+                ])
+            # Files of the other packages are still shared with the current
+            # generation, so make sure that the build hasn't written to them.
+            modified = find_modified_links(
+                get_generation_path(current, 'local'), linked, records
+                )
+            if modified:
+                exit(
+                    "ERROR: The build modified %d files of generation %d in "
+                    "place, e.g. %s, so use `redpill verify --repair` to fix "
+                    "them" % (len(modified), current, modified[0])
+                    )
+        except BaseException:
+            set_prefix(LOCAL_LINK, RECEIPTS_LINK)
+            log("Discarding generation %d" % generation, ERROR)
+            rmdir(get_generation_path(generation))
+            raise
+        set_prefix(LOCAL_LINK, RECEIPTS_LINK)
+        switch_generation(generation)
+        log("Switched to generation %d" % generation, SUCCESS)
+        gc_generations()
+
+# Remove the oldest generations, other than the current one, so that at most
+# ``keep-generations`` are kept.
+def gc_generations():
+    keep = max(int(get_conf('keep-generations', 3)), 1)
+    current = get_current_generation()
+    generations = [
+        generation for generation in list_generations()
+        if generation != current
+        ]
+    for generation in generations[:max(len(generations) - keep + 1, 0)]:
+        log("Removing generation %d" % generation, PROGRESS)
+        rmdir(get_generation_path(generation))
+
+# ------------------------------------------------------------------------------
+# Command Daemon
+# ------------------------------------------------------------------------------
+
+# The daemon keeps the resolved recipes, roles and installed packages in memory
+# and serves commands for the environ over a unix socket. This saves each
+# invocation from paying for Python startup, executing the recipes, etc.
+DAEMON_SOCKET = BUILD_WORKING_DIRECTORY + '.sock'
+
+# Commands are only forwarded to the daemon if the environment variables which
+# are read when redpill is imported match those of the daemon.
+DAEMON_ENVIRON = [
+    'REDPILL_ADMISSION_LEDGER', 'REDPILL_ARTIFACTS', 'REDPILL_BUILD_RECIPES',
+    'REDPILL_DISTFILES', 'REDPILL_DOWNLOAD_JOBS', 'REDPILL_ENVIRON',
+    'REDPILL_JOBS', 'REDPILL_NOCOLOR', 'REDPILL_PRE_INSTALL',
+    'REDPILL_ROLES_PATH', 'REDPILL_STATE'
+    ]
+
+DAEMON_STATE = {}
+
+# Commands change process-wide state, e.g. the environment and working
+# directory, so only one is run at a time. Whilst one is running, any others
+# are handed back to their clients to run themselves instead of waiting.
+DAEMON_BUSY = Lock()
+
+class DaemonStream(object):
+    """File-like object which relays output to a daemon client."""
+
+    softspace = 0
+
+    def __init__(self, send, name):
+        self.send = send
+        self.name = name
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            self.send({self.name: data})
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class DaemonHandler(StreamRequestHandler):
+    """Serve a single request from a redpill client."""
+
+    def handle(self):
+        send_lock = Lock()
+        def send(message):
+            data = encode_json(message, encoding='latin-1') + '\n'
+            with send_lock:
+                self.wfile.write(data)
+        request = decode_json(self.rfile.readline(), encoding='latin-1')
+        if request.get('stop'):
+            DAEMON_STATE['stopping'] = True
+            send({'exit': 0})
+        elif request.get('status'):
+            send({'out': "Daemon %d has served %d commands over %s\n" % (
+                os.getpid(), DAEMON_STATE['served'],
+                format_duration(time() - DAEMON_STATE['started'])
+                )})
+            send({'exit': 0})
+        elif not DAEMON_BUSY.acquire(False):
+            send({'fallback': True})
+        else:
+            try:
+                self.run(request, send)
+            finally:
+                DAEMON_BUSY.release()
+
+    def run(self, request, send):
+        if stat_files([CONF_PATH]) != DAEMON_STATE['conf']:
+            # The config is only read once, so let the client run the
+            # command itself and stop so that a fresh daemon can be started.
+            log("Stopping as the redpill.yaml config has changed", PROGRESS)
+            DAEMON_STATE['stopping'] = True
+            send({'fallback': True})
+        elif [request['env'].get(key) for key in DAEMON_ENVIRON] != [
+            environ.get(key) for key in DAEMON_ENVIRON
+            ]:
+            send({'fallback': True})
+        else:
+            send({'exit': run_daemon_command(request, send)})
+
+class DaemonServer(ThreadingMixIn, UnixStreamServer):
+    """Serve each client within its own thread."""
+
+    daemon_threads = True
+
+    # Wake up periodically to check if the daemon has been asked to stop.
+    timeout = 0.5
+
+# Reset all of the state from a previous command. The resolved recipes and
+# roles, along with the installed packages, are kept for as long as the files
+# they were derived from remain unchanged.
+def reset_state():
+    global DOWNLOAD_POOL, LOCK_WAIT
+    TO_INSTALL.clear()
+    TO_REBUILD.clear()
+    TO_UNINSTALL.clear()
+    KEPT_FILES.clear()
+    TIMINGS.clear()
+    del SPANS[:]
+    del DOWNLOAD_ERROR[:]
+    del DOWNLOAD_QUEUE[:]
+    SUBPROCESS_STATS[:] = [0.0, 0]
+    DOWNLOAD_POOL = TaskPool(limit=int(environ.get('REDPILL_DOWNLOAD_JOBS', 4)))
+    LOCK_WAIT = False
+    if 'REDPILL_WAIT' in environ:
+        LOCK_WAIT = parse_lock_wait(environ['REDPILL_WAIT'])
+    receipts = stat_files([RECEIPTS])
+    if receipts != DAEMON_STATE.get('receipts'):
+        reset_installed_packages()
+        DAEMON_STATE['receipts'] = receipts
+    recipes = DAEMON_STATE.get('recipes')
+    if recipes and not is_fresh(*recipes):
+        RECIPES.clear()
+        PACKAGES.clear()
+        ROLES.clear()
+        del RECIPES_INITIALISED[:]
+        DAEMON_STATE.pop('recipes')
+    if not RECIPES_INITIALISED:
+        DAEMON_STATE['inputs'] = get_manifest_inputs()
+
+# Run the command from the given ``request`` with the client's environment and
+# working directory, relaying its output and returning the exit code.
+def run_daemon_command(request, send):
+    global CURRENT_DIRECTORY, SERVING
+    streams = sys.stdin, sys.stdout, sys.stderr
+    original_environ = environ.copy()
+    held_locks = set(LOCKS)
+    sys.stdin = open(os.devnull, 'rb')
+    sys.stdout = DaemonStream(send, 'out')
+    sys.stderr = DaemonStream(send, 'err')
+    SERVING = True
+    code = 0
+    try:
+        try:
+            environ.clear()
+            for key, value in request['env'].iteritems():
+                environ[key.encode('latin-1')] = value.encode('latin-1')
+            CURRENT_DIRECTORY = request['cwd'].encode('latin-1')
+            chdir(CURRENT_DIRECTORY)
+            reset_state()
+            main([arg.encode('latin-1') for arg in request['argv']])
+        except SystemExit, err:
+            if isinstance(err.code, basestring):
+                sys.stderr.write(err.code + '\n')
+                code = 1
+            else:
+                code = err.code or 0
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        if RECIPES_INITIALISED and 'recipes' not in DAEMON_STATE:
+            DAEMON_STATE['recipes'] = (
+                DAEMON_STATE['inputs'],
+                ) + get_recipe_dependencies()
+    finally:
+        release_build()
+        close_events()
+        for path in list(LOCKS):
+            if path not in held_locks:
+                unlock(path)
+        SERVING = False
+        sys.stdin.close()
+        sys.stdin, sys.stdout, sys.stderr = streams
+        environ.clear()
+        environ.update(original_environ)
+        DAEMON_STATE['served'] += 1
+    return code
+
+def serve_daemon():
+    lock(DAEMON_SOCKET + '.lock', wait=False)
+    if exists(DAEMON_SOCKET):
+        remove(DAEMON_SOCKET)
+    # The socket is created with a restrictive umask, so that there's never a
+    # window in which other users can connect and run commands as us.
+    umask = os.umask(0177)
+    try:
+        server = DaemonServer(DAEMON_SOCKET, DaemonHandler)
+    finally:
+        os.umask(umask)
+    os.chmod(DAEMON_SOCKET, 0600)
+    DAEMON_STATE.update({
+        'conf': stat_files([CONF_PATH]),
+        'served': 0,
+        'started': time()
+        })
+    signal(SIGTERM, lambda *args: sys.exit(0))
+    log("Serving commands for %s on %s" % (ENVIRON, DAEMON_SOCKET), SUCCESS)
+    try:
+        while not DAEMON_STATE.get('stopping'):
+            server.handle_request()
+    finally:
+        # Let any command that's still running finish first.
+        with DAEMON_BUSY:
+            server.server_close()
+        remove(DAEMON_SOCKET)
+        unlock(DAEMON_SOCKET + '.lock')
+
+# Send the given ``request`` to the daemon for the environ, relaying its output
+# and returning the exit code. If there isn't a daemon running, or if it can't
+# serve the request, None is returned so that the command can be run locally.
+def send_daemon_request(request):
+    if not exists(DAEMON_SOCKET):
+        return None
+    client = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        client.connect(DAEMON_SOCKET)
+    except socket_error:
+        client.close()
+        return None
+    try:
+        client.sendall(encode_json(request, encoding='latin-1') + '\n')
+        for line in client.makefile('rb'):
+            message = decode_json(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'].encode('latin-1'))
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'].encode('latin-1'))
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+            elif 'fallback' in message:
+                return None
+    finally:
+        client.close()
+    exit("ERROR: Lost the connection to the redpill daemon.")
+
+# Commands which run builds may prompt, e.g. via sudo() within recipe hooks, but
+# the daemon has no terminal to prompt on, so these are never forwarded.
+def may_prompt(argv):
+    if not argv:
+        return False
+    if argv[0] == 'verify':
+        return '--repair' in argv
+    return argv[0] in ('build', 'install')
+
+def forward_command(argv):
+    return send_daemon_request({
+        'argv': argv,
+        'cwd': getcwd(),
+        'env': dict(environ)
+        })
+
+# ------------------------------------------------------------------------------
+# Main Runner
+# ------------------------------------------------------------------------------
+
+# Run the given command ``handler``, profiling it with cProfile and dumping the
+# stats to the ``profile`` path if one has been specified. As time spent in
+# subprocesses shows up as a single opaque call, we report it separately.
+def run_handler(profile, handler, *args):
+    if not profile:
+        return handler(*args)
+    from cProfile import Profile
+    profiler = Profile()
+    start = time()
+    try:
+        return profiler.runcall(handler, *args)
+    finally:
+        duration = time() - start
+        profiler.dump_stats(profile)
+        subprocess_time, subprocess_count = SUBPROCESS_STATS
+        sys.stderr.write(
+            "Profile written to %s\n"
+            "    total:        %.3fs\n"
+            "    subprocesses: %.3fs (%d commands)\n"
+            "    python:       %.3fs\n" % (
+                profile, duration, subprocess_time, subprocess_count,
+                duration - subprocess_time
+                ))
+
+# The check command is only available if a repo check url is configured. This
+# is only resolved when a command is looked up, so that startup doesn't need to
+# load the config.
+def get_mini_command(command):
+    if command == 'check':
+        if get_conf('repo-check-url', None):
+            return check
+        return None
+    return MINI_COMMANDS.get(command)
+
+def get_usage():
 
     major_listing = '\n'.join(
         "    %-10s %s"
         % (cmd, MAJOR_COMMANDS[cmd].__doc__) for cmd in sorted(MAJOR_COMMANDS)
         )
 
+    mini_commands = dict(MINI_COMMANDS)
+    if get_mini_command('check'):
+        mini_commands['check'] = check
+
     mini_listing = '\n'.join(
         "    %-10s %s"
-        % (cmd, MINI_COMMANDS[cmd].__doc__) for cmd in sorted(MINI_COMMANDS)
+        % (cmd, mini_commands[cmd].__doc__) for cmd in sorted(mini_commands)
         )
 
-    usage = ("""%s\nUsage: redpill <command> [options]
+    return ("""%s\nUsage: redpill [global options] <command> [options]
     \nCommands:
     \n%s\n\n%s
+    \nGlobal Options:
+    \n    --events=json     output progress as JSON lines instead of text
+    --profile <path>  profile the command and dump the stats to path
+    --wait[=<secs>]   wait for locks held by other redpill processes
     \nSee `redpill help <command>` for more info on a specific command.""" %
     (__doc__, major_listing, mini_listing))
 
+def main(argv=None, show_help=False):
+
+    argv = original_argv = argv or sys.argv[1:]
+
+    # Set the script name to ``redpill`` so that OptionParser error messages
+    # don't display a potentially confusing ``redpill.py`` to end users.
+    sys.argv[0] = 'redpill'
+
     if autocomplete:
         autocomplete(
             OptionParser(add_help_option=False),
@@ -1025,6 +4166,47 @@ def main(argv=None, show_help=False):
     elif 'OPTPARSE_AUTO_COMPLETE' in environ:
         sys.exit(1)
 
+    # Handle the global options. The ``--profile`` option, or the
+    # ``$REDPILL_PROFILE`` environment variable, runs the command handler under
+    # cProfile. The ``--wait`` option makes us wait for locks held by other
+    # redpill processes instead of exiting, optionally up to a timeout. The
+    # ``--events=json`` option outputs JSON events in place of the usual text.
+    global LOCK_WAIT
+    events = environ.get('REDPILL_EVENTS')
+    profile = environ.get('REDPILL_PROFILE')
+    while argv and argv[0].startswith(('--events', '--profile', '--wait')):
+        if argv[0] == '--events=json':
+            events = 'json'
+            argv = argv[1:]
+        elif argv[0] == '--wait':
+            LOCK_WAIT = True
+            argv = argv[1:]
+        elif argv[0].startswith('--wait='):
+            LOCK_WAIT = parse_lock_wait(argv[0].split('=', 1)[1])
+            argv = argv[1:]
+        elif argv[0].startswith('--profile='):
+            profile = argv[0].split('=', 1)[1]
+            argv = argv[1:]
+        elif argv[0] == '--profile' and len(argv) > 1:
+            profile = argv[1]
+            argv = argv[2:]
+        else:
+            exit("ERROR: Unknown global option %r" % argv[0])
+
+    # Transparently forward the command to the daemon for the environ if one is
+    # running. This can be disabled by setting ``$REDPILL_NO_DAEMON``. Commands
+    # which emit events to an inherited file descriptor, or which may prompt,
+    # are never forwarded.
+    if argv and argv[0] != 'daemon' and not SERVING and not environ.get(
+        'REDPILL_NO_DAEMON'
+        ) and not (events and events.isdigit()) and not may_prompt(argv):
+        code = forward_command(original_argv)
+        if code is not None:
+            sys.exit(code)
+
+    if events:
+        open_events(events)
+
     if not argv:
         show_help = True
     else:
@@ -1034,8 +4216,9 @@ def main(argv=None, show_help=False):
             if argv:
                 command = argv[0]
                 argv = ['--help']
-                if command in MINI_COMMANDS:
-                    help = MINI_COMMANDS[command].__doc__
+                handler = get_mini_command(command)
+                if handler:
+                    help = handler.__doc__
                     print "Usage: redpill %s\n\n    %s\n" % (command, help)
                     sys.exit()
             else:
@@ -1043,16 +4226,18 @@ def main(argv=None, show_help=False):
         elif command in ['-v', '--version']:
             version()
             sys.exit()
-        elif command in MINI_COMMANDS:
-            MINI_COMMANDS[command]()
-            sys.exit()
+        else:
+            handler = get_mini_command(command)
+            if handler:
+                run_handler(profile, handler)
+                sys.exit()
 
     if show_help:
-        print usage
+        print get_usage()
         sys.exit()
 
     if command in MAJOR_COMMANDS:
-        return MAJOR_COMMANDS[command](argv)
+        return run_handler(profile, MAJOR_COMMANDS[command], argv)
 
     # We support git-command like behaviour. That is, if there's an external
     # binary named ``redpill-foo`` available on the ``$PATH``, then running ``redpill
@@ -1068,6 +4253,122 @@ def main(argv=None, show_help=False):
     if retcode:
         sys.exit(retcode)
 
+# ------------------------------------------------------------------------------
+# Build Utilities
+# ------------------------------------------------------------------------------
+
+# Environment variables which default to paths within the environ, and so
+# mustn't be passed on when building other environs.
+ENVIRON_VARIABLES = [
+    'REDPILL_BUILD_RECIPES', 'REDPILL_PRE_INSTALL', 'REDPILL_ROLES_PATH',
+    'REDPILL_STATE'
+    ]
+
+class PrefixedOutput(object):
+    """File-like object which writes each line to stdout with a prefix."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def write(self, data):
+        sys.stdout.write(self.prefix + data)
+
+    def flush(self):
+        sys.stdout.flush()
+
+# Parse an ``--environ`` spec of the form ``path[:role,...]``.
+def parse_environ_spec(spec):
+    path, _, roles = spec.partition(':')
+    path = os.path.realpath(path)
+    if not isdir(path):
+        exit("ERROR: Couldn't find the environ directory %s" % path)
+    return path, [role for role in roles.split(',') if role]
+
+# Return the command and environment for running redpill with the given ``args``
+# against another environ, as we're bound to the environ we were started for.
+# The distfiles directory and artifacts are shared, so that any distfiles and
+# builds needed by multiple environs are only downloaded and built once.
+def get_environ_command(path, args):
+    env = environ.copy()
+    for key in ENVIRON_VARIABLES:
+        env.pop(key, None)
+    env['REDPILL_DISTFILES'] = DISTFILES
+    env['REDPILL_ENVIRON'] = path
+    if ARTIFACTS:
+        env['REDPILL_ARTIFACTS'] = ARTIFACTS
+    if LOCK_WAIT is True:
+        env['REDPILL_WAIT'] = 'forever'
+    elif LOCK_WAIT is not False:
+        env['REDPILL_WAIT'] = str(LOCK_WAIT)
+    command = [
+        sys.executable, '-c', 'from redpill.main import main; main()'
+        ] + args
+    return command, env
+
+def build_environ(path, roles, args):
+    command, env = get_environ_command(
+        path, ['build'] + ['--role=%s' % role for role in roles] + args
+        )
+    out, retcode = run_command(
+        command, retcode=True, env=env,
+        capture=PrefixedOutput('[%s] ' % basename(path))
+        )
+    return retcode
+
+# Return the plan for building the given ``roles`` of another environ, as given
+# by the plan event of a dry run.
+def plan_environ(path, roles):
+    command, env = get_environ_command(
+        path, ['--events=json', 'build', '--dry-run'] +
+        ['--role=%s' % role for role in roles]
+        )
+    out, retcode = run_command(command, retcode=True, env=env)
+    plan = None
+    errors = []
+    for line in out.splitlines():
+        try:
+            event = decode_json(line)
+        except ValueError:
+            errors.append(line)
+            continue
+        if event.get('event') == 'plan':
+            plan = event
+        elif event.get('level') == 'error':
+            errors.append(event['message'])
+    if retcode or plan is None:
+        exit("ERROR: Couldn't plan the build of %s\n%s" % (
+            path, '\n'.join(errors)
+            ))
+    return plan
+
+# Print the plan across all of the environs being built. Each shared build is
+# attributed to the first environ which needs it, though whichever environ gets
+# to it first actually builds it.
+def print_shared_plan(plans, dry_run):
+    builders = {}
+    builds = shared = 0
+    for name, plan in plans:
+        for package, version in plan['install']:
+            recipe_hash = plan['recipe_hashes'].get(package)
+            if recipe_hash and recipe_hash in builders:
+                if dry_run:
+                    log("[%s] Would reuse the build of %s %s from %s" % (
+                        name, package, version, builders[recipe_hash]
+                        ))
+                shared += 1
+                continue
+            if recipe_hash:
+                builders[recipe_hash] = name
+            if dry_run:
+                log("[%s] Would build %s %s" % (name, package, version))
+            builds += 1
+        if dry_run:
+            for package in plan['uninstall']:
+                log("[%s] Would uninstall %s" % (name, package))
+    log("Planned %d builds across %d environs, with %d shared" % (
+        builds, len(plans), shared
+        ), dry_run and SUCCESS or PROGRESS)
+
 # ------------------------------------------------------------------------------
 # Build Command
 # ------------------------------------------------------------------------------
@@ -1080,13 +4381,87 @@ def build(argv=None, completer=None):
 
     op = OptionParser(usage=usage, add_help_option=False)
 
-    op.add_option('--role', dest='role', default=role,
-                  help="specify the role to build [%s]" % role)
+    op.add_option('--role', dest='roles', action='append', metavar='ROLE',
+                  help="specify a role to build, can be repeated [%s]" % role)
+
+    op.add_option('--environ', dest='environs', action='append', default=[],
+                  metavar='PATH[:ROLE,...]',
+                  help="also build another environ, can be repeated")
+
+    op.add_option('--dry-run', dest='dry_run', action='store_true',
+                  help="show what would be (re)built without doing it")
+
+    op.add_option('--trace', dest='trace', default=environ.get('REDPILL_TRACE'),
+                  help="write a Chrome trace of the build to the given path")
+
+    op.add_option('--capture', dest='capture', action='store_true',
+                  default=bool(environ.get('REDPILL_CAPTURE')),
+                  help="stream build output to per-package log files")
 
     options, args = parse_options(op, argv, completer)
 
-    load_role(options.role)
-    install_packages()
+    roles = options.roles or [role]
+    environs = []
+    for spec in options.environs:
+        path, environ_roles = parse_environ_spec(spec)
+        if path == os.path.realpath(ENVIRON):
+            roles.extend(environ_roles)
+        else:
+            environs.append((path, environ_roles))
+
+    for role in roles:
+        load_role(role)
+
+    if not environs:
+        install_packages(
+            dry_run=options.dry_run, trace=options.trace,
+            capture=options.capture
+            )
+        return
+
+    # A single plan is made across all of the environs, so that builds which
+    # are identical between them, as identified by their recipe hashes, are
+    # only done once.
+    with locked(LOCAL_LOCK, shared=True):
+        plans = [(basename(ENVIRON), get_plan_data(*plan_install()))]
+    pool = TaskPool()
+    for path, environ_roles in environs:
+        pool.spawn(plan_environ, path, environ_roles, task_name=path)
+    plans.extend(
+        (basename(path), plan)
+        for (path, _), plan in zip(environs, pool.wait())
+        )
+    print_shared_plan(plans, options.dry_run)
+    if options.dry_run:
+        return
+
+    # The other environs are built concurrently whilst we build our own. Unless
+    # a persistent ``$REDPILL_ARTIFACTS`` directory has been set, the artifacts
+    # of the shared builds only last for this run.
+    global ARTIFACTS
+    temporary = not ARTIFACTS
+    if temporary:
+        from tempfile import mkdtemp
+        mkdir(BUILD_WORKING_DIRECTORY)
+        ARTIFACTS = mkdtemp(prefix='artifacts-', dir=BUILD_WORKING_DIRECTORY)
+    args = []
+    if options.capture:
+        args.append('--capture')
+    pool = TaskPool()
+    for path, environ_roles in environs:
+        pool.spawn(build_environ, path, environ_roles, args, task_name=path)
+
+    try:
+        install_packages(trace=options.trace, capture=options.capture)
+    finally:
+        results = pool.wait()
+        if temporary:
+            rmdir(ARTIFACTS)
+            ARTIFACTS = None
+
+    failed = [path for (path, _), retcode in zip(environs, results) if retcode]
+    if failed:
+        exit("ERROR: Building failed for %s" % ', '.join(failed))
 
 # ------------------------------------------------------------------------------
 # Check Command
@@ -1102,7 +4477,7 @@ def check():
         ).split()[0]
 
     log("Checking the latest commits on GitHub.", PROGRESS)
-    commit_info = urlopen(get_conf('repo-check-url')).json
+    commit_info = urlopen(get_conf('repo-check-url')).json()
 
     latest_revision_id = commit_info['commit']['sha']
 
@@ -1111,6 +4486,211 @@ def check():
 
     log("Your checkout is up-to-date.", SUCCESS)
 
+# ------------------------------------------------------------------------------
+# Daemon Command
+# ------------------------------------------------------------------------------
+
+def daemon(argv=None, completer=None):
+    """serve commands from a long-running process"""
+
+    usage = "Usage: redpill daemon [options]\n\n    %s" % daemon.__doc__
+    op = OptionParser(usage=usage, add_help_option=False)
+
+    op.add_option('--status', action='store_true',
+                  help="show whether a daemon is running for the environ")
+
+    op.add_option('--stop', action='store_true',
+                  help="stop the running daemon for the environ")
+
+    if completer:
+        return op
+
+    options, args = parse_options(op, argv, completer)
+
+    if SERVING:
+        exit("ERROR: The daemon can't be managed from within itself.")
+
+    if options.status or options.stop:
+        if send_daemon_request({'stop': options.stop, 'status': True}) is None:
+            exit("ERROR: No redpill daemon is running for %s" % ENVIRON)
+        if options.stop:
+            log("Stopped the redpill daemon.", SUCCESS)
+        return
+
+    serve_daemon()
+
+# ------------------------------------------------------------------------------
+# Export Command
+# ------------------------------------------------------------------------------
+
+def export(argv=None, completer=None):
+    """export the local install as a snapshot"""
+
+    usage = "Usage: redpill export [options]\n\n    %s" % export.__doc__
+    op = OptionParser(usage=usage, add_help_option=False)
+
+    op.add_option('--output', dest='output', default='.',
+                  help="directory to write the snapshot to [.]")
+
+    if completer:
+        return op
+
+    options, args = parse_options(op, argv, completer)
+
+    if not isdir(options.output):
+        exit("ERROR: Couldn't find the output directory %s" % options.output)
+
+    lock(BUILD_LOCK, shared=True)
+    mkdir(LOCAL)
+    mkdir(RECEIPTS)
+    with locked(LOCAL_LOCK, shared=True):
+        log("Exporting %d packages" % len(get_installed_packages()))
+        path = create_snapshot(options.output)
+    unlock(BUILD_LOCK)
+
+    log("Exported the snapshot to %s" % path, SUCCESS)
+
+# ------------------------------------------------------------------------------
+# Fetch Command
+# ------------------------------------------------------------------------------
+
+def fetch(argv=None, completer=None):
+    """download the distfiles needed for a build"""
+
+    usage = "Usage: redpill fetch [options] [packages]\n\n    %s" % (
+        fetch.__doc__
+        )
+
+    op = OptionParser(usage=usage, add_help_option=False)
+
+    op.add_option('--role', dest='roles', action='append', metavar='ROLE',
+                  help="specify a role to fetch for, can be repeated")
+
+    op.add_option('--all', dest='all', action='store_true',
+                  help="include the packages which are already installed")
+
+    if completer:
+        return op, ListCompleter(get_recipe_names())
+
+    options, args = parse_options(op, argv, completer)
+
+    roles = options.roles or []
+    if not (args or roles):
+        roles = [get_default_role()]
+
+    init_build_recipes()
+    for package in args:
+        install_package(package)
+    for role in roles:
+        load_role(role)
+
+    if options.all:
+        packages, versions = sort_by_dependencies(TO_INSTALL), TO_INSTALL
+    else:
+        uninstall, packages, versions = plan_install()
+
+    mkdir(DISTFILES)
+    distfiles = []
+    for package in packages:
+        version = versions[package]
+        recipe = RECIPES[package][version]
+        info = BUILD_TYPES[recipe.get('type', 'default')].copy()
+        info.update(recipe)
+        distfile, url = get_distfile(package, version, info)
+        if distfile:
+            distfiles.append(distfile)
+            download_distfile(
+                distfile, url, info['hash'], fork=True, package=package
+                )
+
+    try:
+        DOWNLOAD_POOL.wait()
+    except TaskTimeout, err:
+        DOWNLOAD_ERROR.append(DownloadError(str(err)))
+
+    if DOWNLOAD_ERROR:
+        for err in DOWNLOAD_ERROR:
+            error("ERROR: %s" % err.msg)
+        exit("ERROR: Couldn't fetch %d of %d distfiles" % (
+            len(DOWNLOAD_ERROR), len(distfiles)
+            ))
+
+    log("Fetched %d distfiles" % len(distfiles), SUCCESS)
+
+# ------------------------------------------------------------------------------
+# GC Command
+# ------------------------------------------------------------------------------
+
+def gc(argv=None, completer=None):
+    """remove unused files from the build working directory"""
+
+    usage = "Usage: redpill gc [options]\n\n    %s" % gc.__doc__
+    op = OptionParser(usage=usage, add_help_option=False)
+
+    op.add_option('--cap', dest='cap',
+                  help="evict files until the working directory is under "
+                  "this size, e.g. 2G")
+
+    op.add_option('--dry-run', dest='dry_run', action='store_true',
+                  help="show what would be removed without removing it")
+
+    if completer:
+        return op
+
+    options, args = parse_options(op, argv, completer)
+
+    if options.cap:
+        cap = parse_size(options.cap)
+    else:
+        cap = get_working_directory_cap()
+
+    reclaimed = collect_garbage(cap, options.dry_run)
+    unlock(BUILD_LOCK)
+
+    if options.dry_run:
+        log("Would reclaim %s" % format_size(reclaimed), SUCCESS)
+    else:
+        log("Reclaimed %s" % format_size(reclaimed), SUCCESS)
+
+# ------------------------------------------------------------------------------
+# Import Command
+# ------------------------------------------------------------------------------
+
+def import_snapshot(argv=None, completer=None):
+    """import the local install from a snapshot"""
+
+    usage = (
+        "Usage: redpill import [options] <snapshot>\n\n    %s"
+        % import_snapshot.__doc__
+        )
+
+    op = OptionParser(usage=usage, add_help_option=False)
+
+    op.add_option('--force', action='store_true',
+                  help="replace any existing installed packages")
+
+    if completer:
+        return op
+
+    options, args = parse_options(op, argv, completer, True)
+
+    path = args[0]
+    if not isfile(path):
+        exit("ERROR: Couldn't find the snapshot %s" % path)
+
+    lock(BUILD_LOCK)
+    with locked(GENERATIONS_LOCK), locked(LOCAL_LOCK):
+        if list_receipts() and not options.force:
+            exit(
+                "ERROR: There are already packages installed in %s, use "
+                "--force to replace them" % ENVIRON
+                )
+        metadata = extract_snapshot(path)
+    unlock(BUILD_LOCK)
+
+    log("Imported %d packages from %s" % (len(metadata['installed']), path),
+        SUCCESS)
+
 # ------------------------------------------------------------------------------
 # Info Utilities
 # ------------------------------------------------------------------------------
@@ -1119,12 +4699,15 @@ def get_default_role():
     return get_conf('role', 'default')
 
 def get_build_info():
+    return get_manifest()['build_info']
+
+def get_role_names():
     roles = set()
     for path in ROLES_PATH:
         roles.update([f[:-5] for f in listdir(path) if f.endswith('.yaml')])
-    roles = list(sorted(roles))
-    for role in roles:
-        load_role(role)
+    return list(sorted(roles))
+
+def render_build_info(roles):
     stream = []; write = stream.append
     write('\t\t')
     write(':'.join(roles))
@@ -1150,6 +4733,70 @@ def get_installed_info():
         stream.pop()
     return ''.join(stream)
 
+TIMING_CATEGORIES = [
+    'download', 'verify', 'extract', 'configure', 'make', 'command', 'hook',
+    'listing', 'receipt', 'ensure', 'cleanup', 'uninstall'
+    ]
+
+# Return the detected versions of the toolchain, probing any binaries which
+# aren't in the cache concurrently.
+def get_toolchain_info():
+    pool = TaskPool()
+    ns = globals()
+    for name in TOOLCHAIN:
+        pool.spawn(ns['get_%s_version' % name])
+    versions = pool.wait()
+    stream = []; write = stream.append
+    for name, version in zip(TOOLCHAIN, versions):
+        write(name)
+        write('\t\t')
+        write(version or 'not found')
+        write('\n')
+    return ''.join(stream).rstrip('\n')
+
+def get_timings_info(last):
+    reports = load_timing_reports(last)
+    if not reports:
+        return 'No build timings have been recorded yet.'
+    stream = []; write = stream.append
+    categories = [
+        category for category in TIMING_CATEGORIES
+        if [span for report in reports for span in report['spans']
+            if span['category'] == category]
+        ]
+    write('%-20s %-8s %9s' % ('run', 'status', 'total'))
+    for category in categories:
+        write(' %9s' % category)
+    write('\n')
+    for report in reports:
+        totals = dict.fromkeys(categories, 0)
+        for span in report['spans']:
+            if span['category'] in totals:
+                totals[span['category']] += span['end'] - span['start']
+        write('%-20s %-8s %9s' % (
+            strftime('%Y-%m-%d %H:%M:%S', localtime(report['start'])),
+            report['status'], format_duration(report['duration'])
+            ))
+        for category in categories:
+            write(' %9s' % format_duration(totals[category]))
+        write('\n')
+    packages = {}
+    for report in reports:
+        for package, phases in report['packages'].iteritems():
+            packages.setdefault(package, []).append(sum(phases.values()))
+    slowest = sorted(
+        packages, key=lambda package: -max(packages[package])
+        )[:10]
+    if slowest:
+        write('\nslowest packages:\n')
+        for package in slowest:
+            times = packages[package]
+            write('    %-24s %9s (mean over %d runs: %s)\n' % (
+                package, format_duration(max(times)), len(times),
+                format_duration(sum(times) / len(times))
+                ))
+    return ''.join(stream).rstrip('\n')
+
 # ------------------------------------------------------------------------------
 # Info Command
 # ------------------------------------------------------------------------------
@@ -1175,20 +4822,45 @@ def info(argv=None, completer=None):
         help="output the default redpill role"
         )
 
+    op.add_option(
+        '--timings', action='store_true',
+        help="summarise the phase timings of recent builds"
+        )
+
+    op.add_option(
+        '--toolchain', action='store_true',
+        help="output the detected versions of the toolchain"
+        )
+
+    op.add_option(
+        '--last', type='int', default=10,
+        help="number of recent builds to summarise [10]"
+        )
+
     if completer:
         return op
 
     options, args = parse_options(op, argv, completer)
 
-    lock(BUILD_LOCK)
+    lock(BUILD_LOCK, shared=True)
     if options.role:
         output = get_default_role()
+    elif options.timings:
+        output = get_timings_info(options.last)
+    elif options.toolchain:
+        output = get_toolchain_info()
     elif options.installed:
-        output = get_installed_info()
+        with locked(LOCAL_LOCK, shared=True):
+            output = get_installed_info()
+    elif options.hash:
+        output = get_manifest()['build_info_hash']
     else:
         output = get_build_info()
 
-    if options.hash:
+    if options.hash and (
+        options.role or options.timings or options.toolchain or
+        options.installed
+        ):
         output = sha256(output).hexdigest()
 
     print output
@@ -1208,17 +4880,31 @@ def install(argv=None, completer=None):
 
     op = OptionParser(usage=usage, add_help_option=False)
 
-    init_build_recipes()
+    op.add_option('--dry-run', dest='dry_run', action='store_true',
+                  help="show what would be (re)built without doing it")
+
+    op.add_option('--trace', dest='trace', default=environ.get('REDPILL_TRACE'),
+                  help="write a Chrome trace of the build to the given path")
+
+    op.add_option('--capture', dest='capture', action='store_true',
+                  default=bool(environ.get('REDPILL_CAPTURE')),
+                  help="stream build output to per-package log files")
+
     if completer:
         installed_packages = get_installed_packages()
-        potentials = [pkg for pkg in RECIPES if pkg not in installed_packages]
+        potentials = [
+            pkg for pkg in get_recipe_names() if pkg not in installed_packages
+            ]
         return op, ListCompleter(potentials)
 
+    init_build_recipes()
     options, args = parse_options(op, argv, completer, True)
     for package in args:
         install_package(package)
 
-    install_packages()
+    install_packages(
+        dry_run=options.dry_run, trace=options.trace, capture=options.capture
+        )
 
 # ------------------------------------------------------------------------------
 # Nuke Command
@@ -1236,10 +4922,157 @@ def nuke(argv=None, completer=None):
     options, args = parse_options(op, argv, completer)
 
     lock(BUILD_LOCK)
-    rmdir(LOCAL)
-    rmdir(RECEIPTS)
+    with locked(LOCAL_LOCK):
+        for path in [LOCAL, RECEIPTS]:
+            if islink(path):
+                remove(path)
+            else:
+                rmdir(path)
+        rmdir(GENERATIONS)
     unlock(BUILD_LOCK)
 
+# ------------------------------------------------------------------------------
+# Plan Command
+# ------------------------------------------------------------------------------
+
+def plan(argv=None, completer=None):
+    """show the build plan and estimated times"""
+
+    usage = "Usage: redpill plan [options]\n\n    %s" % plan.__doc__
+    role = get_default_role()
+
+    op = OptionParser(usage=usage, add_help_option=False)
+
+    op.add_option('--role', dest='role', default=role,
+                  help="specify the role to plan [%s]" % role)
+
+    if completer:
+        return op
+
+    options, args = parse_options(op, argv, completer)
+
+    load_role(options.role)
+    with locked(LOCAL_LOCK, shared=True):
+        uninstall, to_install, versions = plan_install()
+    if not (uninstall or to_install):
+        log("All packages are up-to-date.", SUCCESS)
+        return
+
+    installed = get_installed_packages()
+    for package in sorted(uninstall):
+        if package not in versions:
+            log("Would uninstall %s %s" % (package, installed[package]))
+    if not to_install:
+        return
+
+    history = load_build_history()
+    estimates = {}
+    cached = {}
+    for package in to_install:
+        version = versions[package]
+        recipe = RECIPES[package][version]
+        info = BUILD_TYPES[recipe.get('type', 'default')].copy()
+        info.update(recipe)
+        distfile = info['distfile'] % {'name': package, 'version': version}
+        cached[package] = not distfile or isfile(
+            join(DISTFILES, distfile)
+            )
+        estimates[package] = estimate_build_time(
+            package, version, history, cached[package]
+            )
+
+    chains = get_chain_costs(to_install, estimates)
+    print "%4s  %-24s %-16s %10s %10s  %s" % (
+        '#', 'package', 'version', 'estimate', 'chain', 'distfile'
+        )
+    for idx, package in enumerate(to_install):
+        print "%4d  %-24s %-16s %10s %10s  %s" % (
+            idx + 1, package, versions[package][:16],
+            format_duration(estimates[package]),
+            format_duration(chains[package]),
+            cached[package] and 'cached' or 'download'
+            )
+
+    # Walk the critical path through direct dependents only, so that packages
+    # without estimates can't make it skip over intermediate builds.
+    path = []
+    dependents = get_dependents(to_install)
+    candidates = [package for package in to_install if not [
+        dep for dep in get_dependencies(package) if dep in chains
+        ]]
+    while candidates:
+        package = max(candidates, key=lambda package: chains[package])
+        path.append(package)
+        candidates = sorted(dependents.get(package, []))
+
+    print
+    unknown = [package for package in to_install if estimates[package] is None]
+    total = sum(estimates[package] or 0 for package in to_install)
+    log("Estimated total time: %s" % format_duration(total), PROGRESS)
+    log("Critical path: %s (%s)" % (
+        format_duration(chains[path[0]]), ' -> '.join(path)
+        ), PROGRESS)
+    if unknown:
+        log("No build history for: %s" % ', '.join(sorted(unknown)), PROGRESS)
+
+# ------------------------------------------------------------------------------
+# Rollback Command
+# ------------------------------------------------------------------------------
+
+def rollback(argv=None, completer=None):
+    """switch back to a previous generation"""
+
+    usage = "Usage: redpill rollback [options] [generation]\n\n    %s" % (
+        rollback.__doc__
+        )
+
+    op = OptionParser(usage=usage, add_help_option=False)
+
+    op.add_option('--list', dest='list', action='store_true',
+                  help="list the generations which can be switched to")
+
+    if completer:
+        return op, ListCompleter(map(str, list_generations()))
+
+    options, args = parse_options(op, argv, completer)
+
+    current = get_current_generation()
+    if current is None:
+        exit("ERROR: There are no generations for this environ")
+
+    if options.list:
+        for generation in list_generations():
+            receipts = get_generation_path(generation, 'receipts')
+            print "%s %4d  %s  %d packages" % (
+                generation == current and '*' or ' ', generation,
+                strftime('%Y-%m-%d %H:%M:%S', localtime(
+                    stat(get_generation_path(generation)).st_mtime
+                    )),
+                len([f for f in listdir(receipts) if not f.startswith('.')])
+                )
+        return
+
+    if args:
+        try:
+            generation = int(args[0])
+        except ValueError:
+            exit("ERROR: Invalid generation %r" % args[0])
+        if generation not in list_generations():
+            exit("ERROR: Couldn't find generation %d" % generation)
+    else:
+        previous = [g for g in list_generations() if g < current]
+        if not previous:
+            exit("ERROR: There's no generation before %d" % current)
+        generation = previous[-1]
+
+    lock(BUILD_LOCK, shared=True)
+    with locked(GENERATIONS_LOCK):
+        with locked(LOCAL_LOCK):
+            switch_generation(generation)
+    unlock(BUILD_LOCK)
+
+    log("Switched from generation %d to %d" % (current, generation), SUCCESS)
+
 # ------------------------------------------------------------------------------
 # Uninstall Command
 # ------------------------------------------------------------------------------
@@ -1254,15 +5087,107 @@ def uninstall(argv=None, completer=None):
 
     op = OptionParser(usage=usage, add_help_option=False)
 
-    init_build_recipes()
     if completer:
         return op, ListCompleter(get_installed_packages())
 
+    init_build_recipes()
     options, args = parse_options(op, argv, completer, True)
-    for package in args:
-        uninstall_package(package)
+    package_locks = [get_package_lock(package) for package in sorted(args)]
+    for path in package_locks:
+        lock(path)
 
-    uninstall_packages()
+    with locked(INSTALL_LOCK), locked(LOCAL_LOCK):
+        for package in args:
+            uninstall_package(package)
+        uninstall_packages()
+
+# ------------------------------------------------------------------------------
+# Verify Command
+# ------------------------------------------------------------------------------
+
+def verify(argv=None, completer=None):
+    """verify installed packages against their receipts"""
+
+    usage = "Usage: redpill verify [options] [packages]\n\n    %s" % (
+        verify.__doc__
+        )
+
+    op = OptionParser(usage=usage, add_help_option=False)
+
+    op.add_option('--repair', dest='repair', action='store_true',
+                  help="reinstall the packages with modified or missing files")
+
+    op.add_option('-j', '--jobs', dest='jobs', type='int',
+                  default=NUMBER_OF_CPUS,
+                  help="number of processes to hash files with [%d]"
+                  % NUMBER_OF_CPUS)
+
+    if completer:
+        return op, ListCompleter(get_installed_packages())
+
+    options, args = parse_options(op, argv, completer)
+
+    mkdir(LOCAL)
+    mkdir(RECEIPTS)
+    lock(BUILD_LOCK, shared=True)
+    with locked(LOCAL_LOCK, shared=True):
+        installed = get_installed_packages()
+        if args:
+            for package in args:
+                if package not in installed:
+                    exit("ERROR: The %s package isn't installed" % package)
+            packages = dict((package, installed[package]) for package in args)
+        else:
+            packages = dict(installed)
+        log("Verifying %d packages" % len(packages))
+        problems = verify_packages(packages, options.jobs)
+        if args:
+            unowned = []
+        else:
+            unowned = find_unowned_files()
+    unlock(BUILD_LOCK)
+
+    for kind in ['modified', 'missing']:
+        for package, path in problems[kind]:
+            error("%s: %s (%s)" % (kind.title(), path, package))
+    for path in unowned:
+        error("Unowned: %s" % path)
+    if problems['unverified']:
+        affected = set(package for package, path in problems['unverified'])
+        log("Couldn't verify %d files from older receipts of: %s" % (
+            len(problems['unverified']), ', '.join(sorted(affected))
+            ), PROGRESS)
+
+    broken = set(
+        package for kind in ['modified', 'missing']
+        for package, path in problems[kind]
+        )
+    if not (broken or unowned):
+        log("Verified %d packages" % len(packages), SUCCESS)
+        return
+
+    if not options.repair:
+        log("Found %d modified, %d missing and %d unowned files" % (
+            len(problems['modified']), len(problems['missing']), len(unowned)
+            ), ERROR)
+        sys.exit(1)
+
+    # The broken packages are reinstalled at their installed versions, without
+    # rebuilding anything else, whilst the cleanup before any install removes
+    # the unowned files. This goes through the usual install, so that it's done
+    # within a new generation when generations are in use.
+    init_build_recipes()
+    for package in sorted(broken):
+        version = installed[package]
+        if version not in RECIPES.get(package, {}):
+            exit(
+                "ERROR: Can't repair %s as there's no longer a recipe for "
+                "version %s" % (package, version)
+                )
+        TO_INSTALL[package] = version
+        TO_REBUILD.add(package)
+    install_packages()
+    log("Repaired %d packages" % len(broken), SUCCESS)
 
 # ------------------------------------------------------------------------------
 # Version Command
@@ -1279,19 +5204,24 @@ def version():
 
 MAJOR_COMMANDS = {
     'build': build,
+    'daemon': daemon,
+    'export': export,
+    'fetch': fetch,
+    'gc': gc,
+    'import': import_snapshot,
     'info': info,
     'install': install,
     'nuke': nuke,
-    'uninstall': uninstall
+    'plan': plan,
+    'rollback': rollback,
+    'uninstall': uninstall,
+    'verify': verify
     }
 
 MINI_COMMANDS = {
     'version': version
     }
 
-if get_conf('repo-check-url', None):
-    MINI_COMMANDS['check'] = check
-
 # ------------------------------------------------------------------------------
 # Command Autocompletion
 # ------------------------------------------------------------------------------
@@ -1310,5 +5240,9 @@ no_autocomplete = lambda completer: (
 for command in MINI_COMMANDS:
     AUTOCOMPLETE_COMMANDS[command] = no_autocomplete
 
+# The check command is always offered, as working out whether it's available
+# would mean loading the config on every completion.
+AUTOCOMPLETE_COMMANDS['check'] = no_autocomplete
+
 for command in AUTOCOMPLETE_COMMANDS.values():
     command.autocomplete = make_autocompleter(command)
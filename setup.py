@@ -23,11 +23,12 @@ setup(
         ],
     description="A cross-plaform package management framework",
     entry_points=dict(console_scripts=[
-        "redpill = redpill.main:main"
+        "redpill = redpill.main:main",
+        "redpill-benchmark = redpill.benchmark:main"
         ]),
     install_requires=[
         "PyYAML >= 3.10",
-        "requests >= 0.14.1",
+        "requests >= 1.0",
         "simplejson >= 2.6.2",
         "tavutil >= 1.0.2"
         ],